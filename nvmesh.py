@@ -21,25 +21,74 @@
 # Email:         andreas@excelero.com
 
 
+import time
+STARTUP_BEGIN = time.time()
 import logging
-from cmd2 import Cmd, with_argparser, with_category
+import sys
+import importlib
+if 'IPython' not in sys.modules:
+    # cmd2 imports IPython up front only to offer the ipy command, which costs more than the rest of the start up.
+    # Hiding it during the import makes cmd2 skip it. NvmeshShell.do_ipy imports it when it's used.
+    sys.modules['IPython'] = None
+    try:
+        from cmd2 import Cmd, with_argparser, with_category
+    finally:
+        del sys.modules['IPython']
+else:
+    from cmd2 import Cmd, with_argparser, with_category
+import gnureadline as readline
 import argparse
 import json
-import gnureadline as readline
 import atexit
-import sys
 import os
 import getpass
-import paramiko
 import base64
-from humanfriendly.tables import format_smart_table
-import humanfriendly
-import time
-import urllib3
-from multiprocessing import Pool
-import dateutil.parser
 import re
-import requests
+import urllib
+from collections import OrderedDict, deque
+import threading
+import copy
+import contextlib
+import select
+import errno
+import hashlib
+import tarfile
+import pipes
+import io
+import socket
+import Queue
+
+
+class LazyModule:
+    # Stands in for a module and imports it on first use, so one-shot commands only pay for the imports they need.
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+    def load(self):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return self.module
+
+
+paramiko = LazyModule('paramiko')
+requests = LazyModule('requests')
+urllib3 = LazyModule('urllib3')
+humanfriendly = LazyModule('humanfriendly')
+humanfriendly_tables = LazyModule('humanfriendly.tables')
+dateutil_parser = LazyModule('dateutil.parser')
+multiprocessing_pool = LazyModule('multiprocessing.pool')
+
+
+def format_smart_table(data, column_names):
+    return humanfriendly_tables.format_smart_table(data, column_names)
+
+
+def ThreadPool(processes):
+    return multiprocessing_pool.ThreadPool(processes)
 
 __version__ = '53'
 
@@ -60,6 +109,10 @@ NVME_VENDORS = {
     '0x1bb1': 'Seagate'
 }
 
+VOLUME_LIST_FIELDS = ['name', 'health', 'status', 'RAIDLevel', 'dataBlocks', 'parityBlocks', 'protectionLevel',
+                      'blocks', 'blockSize', 'stripeWidth', 'domain', 'serverClasses', 'diskClasses',
+                      'chunks.pRaids.diskSegments.type', 'chunks.pRaids.diskSegments.remainingDirtyBits']
+
 PROTECTION_LEVELS = {
     2: 'Full Separation',
     1: 'Minimal Separation',
@@ -71,6 +124,86 @@ FORMAT_TYPES = {
     'legacy': 'format_raid'
 }
 
+API_CACHE_TTL = {
+    '/servers/all': 10,
+    '/clients/all': 10,
+    '/volumes/all': 10,
+    '/diskClasses/all': 60,
+    '/serverClasses/all': 60,
+    '/managementCluster/all': 30,
+    '/disks/models': 60
+}
+
+API_CACHE_INVALIDATION = {
+    '/volumes/save': ['/volumes/all', '/clients/all'],
+    '/diskClasses/': ['/diskClasses/all', '/disks/models'],
+    '/serverClasses/': ['/serverClasses/all'],
+    '/disks/': ['/disks/models', '/diskClasses/all', '/servers/all', '/volumes/all'],
+    '/servers/': ['/servers/all', '/volumes/all'],
+    '/clients/': ['/clients/all', '/volumes/all']
+}
+
+SETTINGS_DEFAULTS = {
+    'api_parallelism': (16, 'Max. number of concurrent API requests, e.g. when fetching target details.'),
+    'api_page_size': (500, 'Number of records fetched per API request when listing volumes, clients, targets and '
+                           'logs. 0 fetches everything in one request.'),
+    'api_batch_size': (100, 'Max. number of volumes or classes created or deleted with one API request. 0 sends all '
+                            'of them in one request.'),
+    'ssh_idle_timeout': (300, 'Seconds an unused SSH connection is kept open for reuse by later commands.'),
+    'ssh_keepalive': (30, 'Interval in seconds of the keepalive packets sent on open SSH connections. 0 disables '
+                          'them.'),
+    'ssh_parallelism': (32, 'Max. number of hosts the shell runs remote SSH commands on at the same time.'),
+    'ssh_command_timeout': (300, 'Seconds a remote SSH command may go without output before it is given up. 0 waits '
+                                 'forever.'),
+    'ssh_host_deadline': (0, 'Seconds a host may take to finish a parallel remote command before it is reported as '
+                             'timed out and the others carry on. 0 waits for every host.'),
+    'distribute_fanout': (4, 'Number of hosts the distribute command uploads to from this host at the same time.'),
+    'ssh_backend': ('threads', "How remote commands wait for their hosts. 'threads' uses one executor thread per "
+                               "running command, 'eventloop' polls all running commands from one thread and only "
+                               "uses the executor to connect."),
+    'diag_host_size_limit': (1024, 'Maximum size in MiB of the compressed diagnostic data collected from a single '
+                                   'host. The data of hosts above the limit is truncated.'),
+    'diag_host_timeout': (600, 'Seconds the diagnostic data collection may take per host before it is cut off.'),
+    'graceful_stop_timeout': (600, 'Seconds a graceful stop of the targets waits for all target services to go '
+                                   'down. 0 waits forever.'),
+    'readiness_timeout': (600, 'Seconds a cluster start or restart waits for the managers, targets and volumes to be '
+                               'ready for the next phase. 0 waits forever.'),
+    'attach_batch_size': (50, 'Maximum number of volumes passed to one attach or detach command on a client.'),
+    'attach_parallelism': (16, 'Number of clients that attach or detach volumes at the same time.'),
+    'attach_confirm_timeout': (120, 'Seconds to wait for the management server to show attached or detached volumes '
+                                    'on a client.'),
+    'agent_refresh_interval': (5, 'Seconds between the checks of the background agent for cached API responses to '
+                                  'refresh before they expire.'),
+    'snapshot_ttl': (10, 'Seconds the show commands reuse the cluster data fetched by an earlier command of the same '
+                         'shell session.'),
+    'manager_probe_timeout': (2.0, 'Seconds to wait for a management server to answer the connectivity probe when '
+                                   'picking the manager to use.')
+}
+
+# The smallest value allowed for a numeric setting, or the list of valid values of a text setting.
+SETTINGS_LIMITS = {
+    'api_parallelism': 1,
+    'api_page_size': 0,
+    'api_batch_size': 0,
+    'ssh_idle_timeout': 0,
+    'ssh_keepalive': 0,
+    'ssh_parallelism': 1,
+    'ssh_command_timeout': 0,
+    'ssh_host_deadline': 0,
+    'distribute_fanout': 1,
+    'ssh_backend': ['threads', 'eventloop'],
+    'diag_host_size_limit': 1,
+    'diag_host_timeout': 1,
+    'graceful_stop_timeout': 0,
+    'readiness_timeout': 0,
+    'attach_batch_size': 1,
+    'attach_parallelism': 1,
+    'attach_confirm_timeout': 1,
+    'agent_refresh_interval': 1,
+    'snapshot_ttl': 0,
+    'manager_probe_timeout': 0.1
+}
+
 WARNINGS = {
     'delete_volume': 'This operation will DESTROY ALL DATA on the volume selected and is IRREVERSIBLE.\nDo you want to continue? [Yes|No]: ',
     'format_drive': 'This operation will DESTROY ALL DATA on the drives and is IRREVERSIBLE.\nDo you want to continue? [Yes|No]: ',
@@ -82,6 +215,47 @@ WARNINGS = {
     'evict_drive': 'This operation will make any UNPROTECTED VOLUMES supported by this drive IMMEDIATELY UNAVAILABLE. Any PROTECTED VOLUMES will become IMMEDIATELY DEGRADED.\nDo you want to continue? [Yes|No]: '
 }
 
+DIAG_COMMANDS = OrderedDict([
+    ('uname', 'uname -a'),
+    ('uptime', 'uptime'),
+    ('os-release', 'cat /etc/os-release'),
+    ('dmesg', 'dmesg -T'),
+    ('lsblk', 'lsblk -O'),
+    ('nvme-list', 'nvme list'),
+    ('lspci', 'lspci -vvv'),
+    ('ip-addr', 'ip addr'),
+    ('ibstat', 'ibstat'),
+    ('rpm-nvmesh', 'rpm -qa | grep -i nvmesh'),
+    ('nvmesh-services', 'systemctl status nvmeshtarget nvmeshclient nvmeshmgr --no-pager'),
+    ('journal-nvmesh', 'journalctl -u nvmeshtarget -u nvmeshclient -u nvmeshmgr --no-pager --since "-7 days"'),
+    ('proc-nvmesh', 'find /proc/nvmesh* -type f -exec grep -H . {} +'),
+])
+
+DIAG_PATHS = ['var/log/NVMesh', 'etc/opt/NVMesh', 'opt/NVMesh/client-repo/nvmesh.conf', 'var/log/messages',
+              'var/log/syslog']
+
+DIAG_API_STATE = OrderedDict([
+    ('status', '/status'),
+    ('servers', '/servers/all/0/0'),
+    ('clients', '/clients/all/0/0'),
+    ('volumes', '/volumes/all/0/0'),
+    ('logs', '/logs/all/0/0?filter={}&sort={"timestamp":-1}'),
+])
+
+STARTUP_CATEGORIES = {
+    'local': ['show version', 'show license', 'show setting', 'show host', 'show sshuser', 'show apiuser', 'help',
+              'exit', 'define', ''],
+    'ssh': ['check', 'start', 'stop', 'restart', 'runcmd', 'testssh', 'distribute', 'collect', 'attach', 'detach'],
+}
+
+# Cold start budget in seconds of a fresh interpreter that imports nvmesh and loads the modules a command category
+# needs. All other commands are API commands. startup_benchmark.py checks them.
+STARTUP_BUDGETS = {
+    'local': (0.3, []),
+    'api': (0.6, [requests, urllib3]),
+    'ssh': (1.0, [requests, urllib3, paramiko]),
+}
+
 __license__ = r"""GNU GENERAL PUBLIC LICENSE
 Version 3, 29 June 2007
 Copyright (C) 2007 Free Software Foundation, Inc. <http://fsf.org/>
@@ -287,6 +461,11 @@ class OutputFormatter:
             output.append(output_line)
         return "\n".join(output)
 
+    @staticmethod
+    def stream_tsv(content):
+        for line in content:
+            yield "\t".join(str(item) for item in line)
+
     @staticmethod
     def print_json(content):
         return json.dumps(content, indent=2)
@@ -300,6 +479,50 @@ class OutputFormatter:
         return '\n'.join(text_lines)
 
 
+class ProgressLine:
+    def __init__(self):
+        self.enabled = sys.stderr.isatty()
+        self.width = 0
+
+    def update(self, text):
+        if self.enabled:
+            self.clear()
+            sys.stderr.write(text)
+            sys.stderr.flush()
+            self.width = len(text)
+
+    def clear(self):
+        if self.enabled and self.width:
+            sys.stderr.write("\r%s\r" % (" " * self.width))
+            sys.stderr.flush()
+            self.width = 0
+
+
+class DiagArchive:
+    # One local tar file that many threads add data to. Host output arrives as a stream of unknown length, so it is
+    # written as numbered parts of at most chunk_size bytes each, and memory use stays at one chunk per host.
+    chunk_size = 4 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.tar = tarfile.open(path, 'w')
+        self.lock = threading.Lock()
+        self.added_bytes = 0
+
+    def add(self, name, data):
+        member = tarfile.TarInfo(name)
+        member.size = len(data)
+        member.mtime = time.time()
+        member.mode = 0o644
+        with self.lock:
+            self.tar.addfile(member, io.BytesIO(data))
+            self.added_bytes += len(data)
+
+    def close(self):
+        with self.lock:
+            self.tar.close()
+
+
 class Hosts:
     def __init__(self):
         self.host_list = []
@@ -359,6 +582,45 @@ class ManagementServer:
         return
 
 
+class Settings:
+    def __init__(self):
+        self.settings_file = os.path.expanduser('~/.nvmesh_shell_settings')
+        self.settings = None
+
+    def load_settings(self):
+        self.settings = {}
+        if os.path.isfile(self.settings_file):
+            try:
+                self.settings = json.loads(open(self.settings_file, 'r').read())
+            except Exception, e:
+                logging.warning("Cannot read the shell settings from %s. %s" % (self.settings_file, e.message))
+
+    def get(self, name):
+        if self.settings is None:
+            self.load_settings()
+        return self.settings.get(name, SETTINGS_DEFAULTS[name][0])
+
+    def save(self, name, value):
+        if self.settings is None:
+            self.load_settings()
+        default = SETTINGS_DEFAULTS[name][0]
+        if isinstance(default, bool):
+            value = str(value).lower() in ['true', 'yes', '1']
+        else:
+            value = type(default)(value)
+            limit = SETTINGS_LIMITS.get(name)
+            if isinstance(limit, list) and value not in limit:
+                raise ValueError("Valid values are: %s" % ", ".join(limit))
+            elif limit is not None and not isinstance(limit, list) and value < limit:
+                raise ValueError("The minimum is %s." % limit)
+        self.settings[name] = value
+        open(self.settings_file, 'w').write(json.dumps(self.settings, indent=2))
+
+    def list_settings(self):
+        return [[name, self.get(name), SETTINGS_DEFAULTS[name][0], SETTINGS_DEFAULTS[name][1]]
+                for name in sorted(SETTINGS_DEFAULTS)]
+
+
 class UserCredentials:
     def __init__(self):
         self.SSH_user_name = None
@@ -435,6 +697,195 @@ class UserCredentials:
             return self.API_user_name
 
 
+class SSHConnectionPool:
+    def __init__(self):
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.reaper = None
+
+    @contextlib.contextmanager
+    def connection(self, host, user_name, password, port):
+        key = (host, port, user_name)
+        client = self.acquire(key, password)
+        try:
+            yield client
+        except Exception:
+            self.discard(key, client)
+            raise
+        finally:
+            self.release(key)
+
+    def acquire(self, key, password):
+        with self.lock:
+            entry = self.connections.get(key)
+            if entry is not None:
+                if entry[0].get_transport() is not None and entry[0].get_transport().is_active():
+                    entry[2] += 1
+                    return entry[0]
+                del self.connections[key]
+                if entry[2] == 0:
+                    entry[0].close()
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(key[0], username=key[2], password=password, timeout=5, port=key[1])
+        if settings.get('ssh_keepalive') > 0:
+            client.get_transport().set_keepalive(settings.get('ssh_keepalive'))
+        with self.lock:
+            entry = self.connections.get(key)
+            if entry is not None and entry[0].get_transport() is not None and entry[0].get_transport().is_active():
+                # Another thread connected to the same host in the meantime, keep only one of the transports.
+                client.close()
+            else:
+                entry = self.connections[key] = [client, time.time(), 0]
+            entry[2] += 1
+            self.start_reaper()
+            return entry[0]
+
+    def release(self, key):
+        with self.lock:
+            entry = self.connections.get(key)
+            if entry is not None:
+                entry[1] = time.time()
+                entry[2] -= 1
+
+    def discard(self, key, client):
+        with self.lock:
+            entry = self.connections.get(key)
+            if entry is not None and entry[0] is client:
+                del self.connections[key]
+        client.close()
+
+    def start_reaper(self):
+        if self.reaper is None or not self.reaper.is_alive():
+            self.reaper = threading.Thread(target=self.reap_idle_connections)
+            self.reaper.daemon = True
+            self.reaper.start()
+
+    def reap_idle_connections(self):
+        while True:
+            time.sleep(5)
+            with self.lock:
+                idle_keys = [key for key, entry in self.connections.items()
+                             if entry[2] == 0 and time.time() - entry[1] > settings.get('ssh_idle_timeout')]
+                idle_connections = [(key[0], self.connections.pop(key)[0]) for key in idle_keys]
+                if not self.connections and not idle_connections:
+                    self.reaper = None
+                    return
+            for host, client in idle_connections:
+                logging.debug("Closing the idle SSH connection to %s" % host)
+                client.close()
+
+    def close_all(self):
+        with self.lock:
+            clients = [entry[0] for entry in self.connections.values()]
+            self.connections = {}
+        for client in clients:
+            client.close()
+
+
+class SSHEventLoop:
+    # Drives the channels of all running remote commands from a single thread, instead of parking one thread per host
+    # on recv_exit_status(). Connections still come from the SSH connection pool.
+    def __init__(self):
+        self.new_sessions = Queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, host, user_name, password, port, remote_command, stdin_data, callback):
+        # Connecting blocks on the handshake, so it runs on the bounded SSH executor. callback(result, error) is called
+        # from the event loop thread once the command has finished.
+        get_ssh_executor().apply_async(self.open_session,
+                                       (host, user_name, password, port, remote_command, stdin_data, callback))
+
+    def run(self, host, user_name, password, port, remote_command, stdin_data):
+        finished = threading.Event()
+        outcome = []
+
+        def callback(result, error):
+            outcome.extend([result, error])
+            finished.set()
+
+        self.open_session(host, user_name, password, port, remote_command, stdin_data, callback)
+        while not finished.wait(1):
+            pass
+        if outcome[1] is not None:
+            raise outcome[1]
+        return outcome[0]
+
+    def open_session(self, host, user_name, password, port, remote_command, stdin_data, callback):
+        key = (host, port, user_name)
+        try:
+            client = ssh_pool.acquire(key, password)
+        except Exception, e:
+            callback(None, e)
+            return
+        try:
+            channel = client.get_transport().open_session()
+            channel.exec_command(remote_command)
+            if stdin_data:
+                channel.sendall(stdin_data)
+        except Exception, e:
+            ssh_pool.discard(key, client)
+            ssh_pool.release(key)
+            callback(None, e)
+            return
+        self.new_sessions.put({"key": key, "client": client, "channel": channel, "stdout": [], "stderr": [],
+                               "last_activity": time.time(), "callback": callback})
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.loop)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def loop(self):
+        poller = select.poll()
+        sessions = {}
+        while True:
+            try:
+                while True:
+                    session = self.new_sessions.get(block=not sessions, timeout=None if sessions else 60)
+                    sessions[session["channel"].fileno()] = session
+                    poller.register(session["channel"].fileno(), select.POLLIN)
+            except Queue.Empty:
+                if not sessions:
+                    with self.lock:
+                        if self.new_sessions.empty():
+                            self.thread = None
+                            return
+                    continue
+            poller.poll(100)
+            for fileno, session in sessions.items():
+                if self.pump(session):
+                    poller.unregister(fileno)
+                    del sessions[fileno]
+
+    @staticmethod
+    def pump(session):
+        channel = session["channel"]
+        while channel.recv_ready():
+            session["stdout"].append(channel.recv(32768))
+            session["last_activity"] = time.time()
+        while channel.recv_stderr_ready():
+            session["stderr"].append(channel.recv_stderr(32768))
+            session["last_activity"] = time.time()
+        result, error = None, None
+        if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+            result = channel.recv_exit_status(), "".join(session["stdout"]).strip(), "".join(session["stderr"]).strip()
+            channel.close()
+        elif settings.get('ssh_command_timeout') and \
+                time.time() - session["last_activity"] > settings.get('ssh_command_timeout'):
+            error = socket.timeout("No output for %s seconds." % settings.get('ssh_command_timeout'))
+            ssh_pool.discard(session["key"], session["client"])
+        else:
+            return False
+        ssh_pool.release(session["key"])
+        try:
+            session["callback"](result, error)
+        except Exception, e:
+            logging.critical(e.message)
+        return True
+
+
 class SSHRemoteOperations:
     def __init__(self):
         self.remote_path = "/tmp/nvmesh_diag/"
@@ -449,8 +900,10 @@ class SSHRemoteOperations:
         self.remote_stdout = None
         self.remote_command_return = None
         self.remote_command_error = None
-        self.ssh_user_name = user.get_ssh_user()[0]
-        self.ssh_password = user.get_ssh_user()[1]
+        if user.SSH_user_name is None or user.SSH_sudo is None:
+            user.get_ssh_user()
+        self.ssh_user_name = user.SSH_user_name
+        self.ssh_password = user.SSH_password
 
     def test_ssh_connection(self, host_list):
         if host_list is None:
@@ -459,58 +912,179 @@ class SSHRemoteOperations:
             host_list = get_client_list(False)
             host_list.extend(get_target_list(short=True))
             host_list.extend(get_manager_list(short=True))
-            host_list = set(host_list)
+        host_list = sorted(set(host_list))
+        # All hosts get their TCP connect at once, the SSH handshake only runs for the hosts that accepted it.
+        tcp_results = connect_tcp(host_list, self.ssh_port, 5)
+        results = Queue.Queue()
+        executor = get_ssh_executor()
+        pending = 0
         for host in host_list:
-            try:
-                self.ssh.connect(
-                    host, username=user.SSH_user_name, password=user.SSH_password, timeout=5, port=self.ssh_port)
-                self.ssh.close()
-                print(" ".join(['Connection to %s' % host, formatter.green('OK')]))
-            except Exception, e:
-                print(" ".join(['Connection to %s' % host, formatter.red('Failed:'), e.message]))
-                self.ssh.close()
-        return
+            sock, connect_latency, error = tcp_results[host]
+            if sock is None:
+                yield " ".join(['Connection to %s' % host, formatter.red('Failed:'), error])
+            else:
+                executor.apply_async(self.test_ssh_host, (host, sock, connect_latency, results))
+                pending += 1
+        latency_list = []
+        while pending > 0:
+            host, latencies, error = results.get()
+            pending -= 1
+            if error is not None:
+                yield " ".join(['Connection to %s' % host, formatter.red('Failed:'), error])
+            else:
+                latency_list.append([host] + ["%.1f ms" % (latency * 1000) for latency in latencies] +
+                                    ["%.1f ms" % (sum(latencies) * 1000), sum(latencies)])
+                yield " ".join(['Connection to %s' % host, formatter.green('OK'),
+                                "(connect %s, auth %s, exec %s)" % tuple(latency_list[-1][1:4])])
+        if len(latency_list) > 1:
+            yield "\nSlowest hosts:"
+            yield format_smart_table([line[:-1] for line in sorted(latency_list, key=lambda line: -line[-1])[:5]],
+                                     ['Host', 'Connect', 'Auth', 'Exec', 'Total'])
+
+    @staticmethod
+    def test_ssh_host(host, sock, connect_latency, results):
+        transport = None
+        try:
+            sock.setblocking(1)
+            sock.settimeout(5)
+            transport = paramiko.Transport(sock)
+            transport.banner_timeout = 5
+            transport.auth_timeout = 5
+            start = time.time()
+            transport.start_client(timeout=5)
+            transport.auth_password(user.SSH_user_name, user.SSH_password)
+            auth_latency = time.time() - start
+            start = time.time()
+            channel = transport.open_session(timeout=5)
+            channel.settimeout(5)
+            channel.exec_command('true')
+            channel.recv(1)
+            channel.recv_exit_status()
+            exec_latency = time.time() - start
+            results.put((host, (connect_latency, auth_latency, exec_latency), None))
+        except Exception, e:
+            results.put((host, None, str(e) or e.__class__.__name__))
+        finally:
+            if transport is not None:
+                transport.close()
+            else:
+                sock.close()
 
     def transfer_files(self, host, list_of_files):
         try:
-            self.ssh.connect(
-                host, username=user.SSH_user_name, password=user.SSH_password, timeout=5, port=self.ssh_port)
-            self.sftp = self.ssh.open_sftp()
-            try:
-                self.sftp.chdir(self.remote_path)
-            except IOError:
-                self.sftp.mkdir(self.remote_path)
-            for file_to_transfer in list_of_files:
-                self.sftp.put(self.local_path + "/" + file_to_transfer, self.remote_path + "/" + file_to_transfer)
-            self.sftp.close()
-            self.ssh.close()
+            with ssh_pool.connection(host, user.SSH_user_name, user.SSH_password, self.ssh_port) as ssh:
+                self.sftp = ssh.open_sftp()
+                try:
+                    self.sftp.chdir(self.remote_path)
+                except IOError:
+                    self.sftp.mkdir(self.remote_path)
+                for file_to_transfer in list_of_files:
+                    self.put_file(self.sftp, self.local_path + "/" + file_to_transfer,
+                                  self.remote_path + "/" + file_to_transfer)
+                self.sftp.close()
             return formatter.green("File transfer to host %s OK" % host)
         except Exception, e:
             cli_exit.error = True
             return formatter.red("File transfer to %s Failed! " % host + e.message)
 
+    @staticmethod
+    def put_file(sftp, local_file, remote_file):
+        # Pipelined writes don't wait for the server to acknowledge each packet before sending the next one.
+        with open(local_file, 'rb') as source:
+            with sftp.open(remote_file, 'wb') as target:
+                target.set_pipelined(True)
+                while True:
+                    data = source.read(1024 * 1024)
+                    if not data:
+                        break
+                    target.write(data)
+
+    def upload_files(self, host, file_list, remote_path):
+        self.run_remote_command(host, "mkdir -p %s" % remote_path, None)
+        with ssh_pool.connection(host, self.ssh_user_name, self.ssh_password, self.ssh_port) as ssh:
+            sftp = ssh.open_sftp()
+            try:
+                for local_file in file_list:
+                    self.put_file(sftp, local_file, "/".join([remote_path, os.path.basename(local_file)]))
+            finally:
+                sftp.close()
+
+    def relay_files(self, source_host, host, file_list, remote_path):
+        # The seeded source host copies the files on to the next host itself. This needs SSH key trust between the
+        # cluster nodes, e.g. a shared root key.
+        self.run_remote_command(host, "mkdir -p %s" % remote_path, None)
+        remote_files = " ".join("/".join([remote_path, os.path.basename(local_file)]) for local_file in file_list)
+        exit_code, std_output, std_error = self.run_remote_command(
+            source_host, "scp -q -o BatchMode=yes -o StrictHostKeyChecking=no %s %s:%s/" % (remote_files, host,
+                                                                                             remote_path), None)
+        if exit_code != 0:
+            raise Exception("Relay from %s failed. %s" % (source_host, std_error or std_output))
+
+    def get_diag_command(self):
+        # Collects into a scratch directory below remote_path and writes the compressed tar of it to stdout.
+        collect = " ; ".join("{ %s ; } > cmd/%s.txt 2>&1" % (command, name) for name, command in DIAG_COMMANDS.items())
+        return "sh -c %s" % pipes.quote(
+            'mkdir -p %s && d=$(mktemp -d %s/XXXXXX) && cd $d && mkdir cmd && { %s ; } ; '
+            'p=$(cd / && ls -d %s 2>/dev/null) ; tar -czf - --ignore-failed-read -C $d cmd ${p:+-C / $p} ; rc=$? ; '
+            'cd / ; rm -rf $d ; exit $rc' % (self.remote_path, self.remote_path.rstrip('/'), collect,
+                                              " ".join(DIAG_PATHS)))
+
+    def collect_diag(self, host, archive, name):
+        # Streams the remote tar output straight into the archive. Returns the number of bytes and a list of problems.
+        remote_command, stdin_data = self.prepare_command(self.get_diag_command())
+        size_limit = settings.get('diag_host_size_limit') * 1024 * 1024
+        deadline = time.time() + settings.get('diag_host_timeout')
+        problems = []
+        received = 0
+        part = 0
+        chunk = []
+        chunk_length = 0
+        std_error = ""
+        with ssh_pool.connection(host, self.ssh_user_name, self.ssh_password, self.ssh_port) as ssh:
+            channel = ssh.get_transport().open_session()
+            channel.settimeout(1)
+            channel.exec_command(remote_command)
+            if stdin_data:
+                channel.sendall(stdin_data)
+            try:
+                while True:
+                    if channel.recv_stderr_ready():
+                        std_error = (std_error + channel.recv_stderr(32768))[-4096:]
+                    if time.time() > deadline:
+                        problems.append("timed out after %s seconds" % settings.get('diag_host_timeout'))
+                        break
+                    try:
+                        data = channel.recv(65536)
+                    except socket.timeout:
+                        continue
+                    if not data:
+                        break
+                    if received + len(data) > size_limit:
+                        data = data[:size_limit - received]
+                        problems.append("truncated at %s MiB" % settings.get('diag_host_size_limit'))
+                    received += len(data)
+                    chunk.append(data)
+                    chunk_length += len(data)
+                    if chunk_length >= archive.chunk_size or problems:
+                        archive.add("%s.%03d" % (name, part), "".join(chunk))
+                        part += 1
+                        chunk = []
+                        chunk_length = 0
+                    if problems:
+                        break
+                if chunk:
+                    archive.add("%s.%03d" % (name, part), "".join(chunk))
+                if not problems and channel.recv_exit_status() != 0:
+                    problems.append("exit code %s %s" % (channel.recv_exit_status(), std_error.strip()))
+            finally:
+                channel.close()
+        return received, problems
+
     def return_remote_command_std_output(self, host, remote_command):
         try:
-            self.ssh.connect(host, username=self.ssh_user_name, password=self.ssh_password, timeout=5,
-                             port=self.ssh_port)
-            if user.SSH_sudo.lower() == 'true':
-                remote_command = " ".join(["sudo -S -p ''", remote_command])
-            stdin, stdout, stderr = self.ssh.exec_command(remote_command)
-            if user.SSH_sudo.lower() == 'true':
-                stdin.write(user.SSH_password + "\n")
-                stdin.flush()
-            self.remote_command_return = stdout.channel.recv_exit_status(), stdout.read().strip(), stderr.read().strip()
-            if self.remote_command_return[0] == 0:
-                return self.remote_command_return[0], self.remote_command_return[1]
-            elif self.remote_command_return[0] == 3:
-                cli_exit.error = True
-                return "Service not running."
-            elif self.remote_command_return[0] == 127:
-                cli_exit.error = True
-                return self.remote_command_return[0], remote_command + " not found or not installed!"
-            else:
-                cli_exit.error = True
-                return self.remote_command_return[0], " ".join([remote_command, self.remote_command_return[1]])
+            remote_command, stdin_data = self.prepare_command(remote_command)
+            self.remote_command_return = self.run_remote_command(host, remote_command, stdin_data)
+            return self.map_command_return(remote_command, self.remote_command_return)
         except Exception, e:
             cli_exit.error = True
             logging.critical(e.message)
@@ -518,21 +1092,50 @@ class SSHRemoteOperations:
 
     def execute_remote_command(self, host, remote_command):
         try:
-            self.ssh.connect(host.strip(), username=user.SSH_user_name, password=user.SSH_password, timeout=5,
-                             port=self.ssh_port)
             if user.SSH_sudo:
                 remote_command = " ".join(["sudo -S -p ''", remote_command])
-            stdin, stdout, stderr = self.ssh.exec_command(remote_command)
-            if user.SSH_sudo:
-                stdin.write(user.SSH_password + "\n")
-                stdin.flush()
-            return stdout.channel.recv_exit_status(), "Success - OK"
+            return self.run_remote_command(host.strip(), remote_command,
+                                           user.SSH_password + "\n" if user.SSH_sudo else None)[0], "Success - OK"
         except Exception, e:
             logging.critical(e.message)
             cli_exit.error = True
             print formatter.print_red("Couldn't execute command %s on %s!" % (remote_command, host))
             return
 
+    @staticmethod
+    def prepare_command(remote_command):
+        # Returns the command line to run and the data to send to its stdin, i.e. the sudo password if sudo is used.
+        if user.SSH_sudo.lower() == 'true':
+            return " ".join(["sudo -S -p ''", remote_command]), user.SSH_password + "\n"
+        return remote_command, None
+
+    def run_remote_command(self, host, remote_command, stdin_data):
+        # Returns exit code, stdout and stderr of the command, run on the backend set with the ssh_backend setting.
+        if settings.get('ssh_backend') == 'eventloop':
+            return ssh_event_loop.run(host, self.ssh_user_name, self.ssh_password, self.ssh_port, remote_command,
+                                      stdin_data)
+        with ssh_pool.connection(host, self.ssh_user_name, self.ssh_password, self.ssh_port) as ssh:
+            stdin, stdout, stderr = ssh.exec_command(remote_command, timeout=settings.get('ssh_command_timeout') or None)
+            if stdin_data:
+                stdin.write(stdin_data)
+                stdin.flush()
+            std_output, std_error = stdout.read().strip(), stderr.read().strip()
+            return stdout.channel.recv_exit_status(), std_output, std_error
+
+    @staticmethod
+    def map_command_return(remote_command, remote_command_return):
+        if remote_command_return[0] == 0:
+            return remote_command_return[0], remote_command_return[1]
+        elif remote_command_return[0] == 3:
+            cli_exit.error = True
+            return "Service not running."
+        elif remote_command_return[0] == 127:
+            cli_exit.error = True
+            return remote_command_return[0], remote_command + " not found or not installed!"
+        else:
+            cli_exit.error = True
+            return remote_command_return[0], " ".join([remote_command, remote_command_return[1]])
+
     def check_if_service_is_running(self, host, service):
         try:
             cmd_output = self.execute_remote_command(host, "/opt/NVMesh/%s/services/%s status" % (service, service))
@@ -549,6 +1152,246 @@ class SSHRemoteOperations:
             print formatter.print_red("Couldn't verify service %s on %s !" % (service, host) + e.message)
 
 
+class ApiResponseCache:
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.size = 0
+        self.max_size = 64 * 1024 * 1024
+        self.lock = threading.RLock()
+        self.last_used = {}
+        self.generation = 0
+        self.invalidated = []
+
+    @staticmethod
+    def get_ttl(endpoint):
+        for prefix, ttl in API_CACHE_TTL.items():
+            if endpoint.startswith(prefix):
+                return ttl
+        return None
+
+    def get(self, server, endpoint):
+        with self.lock:
+            key = (server, endpoint)
+            if key not in self.entries:
+                return None
+            expiry, content = self.entries.pop(key)
+            if expiry < time.time():
+                self.size -= len(content)
+                return None
+            self.entries[key] = (expiry, content)
+            self.last_used[key] = time.time()
+            return content
+
+    def get_expiring(self, within, used_since):
+        # The keys of the entries that expire within the next seconds and were read after used_since.
+        with self.lock:
+            for key in [key for key in self.last_used if key not in self.entries or self.last_used[key] < used_since]:
+                del self.last_used[key]
+            return [key for key, (expiry, _) in self.entries.items()
+                    if key in self.last_used and expiry < time.time() + within]
+
+    def put(self, server, endpoint, content):
+        ttl = self.get_ttl(endpoint)
+        if ttl is None or content is None or len(content) > self.max_size:
+            return
+        with self.lock:
+            key = (server, endpoint)
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key)[1])
+            self.entries[key] = (time.time() + ttl, content)
+            self.last_used.setdefault(key, time.time())
+            self.size += len(content)
+            while self.size > self.max_size:
+                self.size -= len(self.entries.popitem(last=False)[1][1])
+
+    def discard(self, condition):
+        with self.lock:
+            for key in [key for key in self.entries if condition(key)]:
+                self.size -= len(self.entries.pop(key)[1])
+
+    def invalidate(self, endpoint):
+        self.generation += 1
+        self.invalidated.append(endpoint)
+        for prefix, related_endpoints in API_CACHE_INVALIDATION.items():
+            if endpoint.startswith(prefix):
+                self.discard(lambda key: any(key[1].startswith(related) for related in related_endpoints))
+                return
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.generation += 1
+
+
+class ClusterSnapshot:
+    # The cluster as seen by the show and get functions, kept per section and indexed. A section is only fetched when a
+    # command needs it, is fetched again once it's older than snapshot_ttl or after a change through the API, and
+    # sections asked for together are fetched at the same time. Filtered listings and streamed output don't use the
+    # snapshot, they have the manager filter and sort the records and stream them page by page.
+    sections = OrderedDict([
+        ('servers', lambda api: list(api.iter_servers())),
+        ('clients', lambda api: list(api.iter_clients())),
+        ('volumes', lambda api: list(api.iter_volumes(ApiQuery().only(VOLUME_LIST_FIELDS)))),
+        ('volume_layouts', lambda api: list(api.iter_volumes())),
+        ('drive_classes', lambda api: json.loads(api.get_disk_classes())),
+        ('target_classes', lambda api: json.loads(api.get_target_classes())),
+        ('vpgs', lambda api: json.loads(api.get_vpgs())),
+        ('managers', lambda api: json.loads(api.get_managers())),
+    ])
+
+    def __init__(self, api):
+        self.api = api
+        self.lock = threading.RLock()
+        self.records = {}
+        self.fetched = {}
+        self.disks_by_id = {}
+        self.server_details = {}
+        self.segment_index = None
+
+    def is_stale(self, section):
+        if section not in self.fetched:
+            return True
+        fetched, generation = self.fetched[section]
+        return time.time() - fetched > settings.get('snapshot_ttl') or generation != self.api.cache.generation
+
+    def fetch(self, sections):
+        with self.lock:
+            stale = [section for section in sections if self.is_stale(section)]
+            if stale:
+                generation = self.api.cache.generation
+                start = time.time()
+                for section, records in zip(stale, fetch_concurrently(lambda api, section: self.sections[section](api),
+                                                                      stale)):
+                    self.records[section] = records
+                    self.fetched[section] = (start, generation)
+                    self.build_indexes(section)
+                logging.debug("Cluster snapshot fetched %s in %.3fs" % (", ".join(stale), time.time() - start))
+            return [self.records[section] for section in sections]
+
+    def build_indexes(self, section):
+        records = self.records[section]
+        if section == 'servers':
+            self.disks_by_id = dict((disk['diskID'], (server, disk)) for server in records
+                                    for disk in server.get('disks', []))
+            self.server_details = {}
+        elif section == 'volume_layouts':
+            self.segment_index = None
+
+    def get(self, section):
+        return self.fetch([section])[0]
+
+    @staticmethod
+    def matches(record, field, hosts, health_filter):
+        return (hosts is None or record[field].split('.')[0] in hosts) \
+            and (health_filter is None or record['health'] in health_filter)
+
+    def get_servers(self, hosts=None, health_filter=None, stream=False):
+        if stream or hosts is not None or health_filter is not None:
+            query = ApiQuery().where_host('node_id', hosts).where('health', health_filter).order_by('node_id')
+            servers = self.api.iter_servers(query)
+        else:
+            servers = sorted(self.get('servers'), key=lambda server: server['node_id'])
+        return (server for server in servers if self.matches(server, 'node_id', hosts, health_filter))
+
+    def get_clients(self, hosts=None, health_filter=None, stream=False):
+        if stream or hosts is not None or health_filter is not None:
+            query = ApiQuery().where_host('client_id', hosts).where('health', health_filter).order_by('client_id')
+            clients = self.api.iter_clients(query)
+        else:
+            clients = sorted(self.get('clients'), key=lambda client: client['client_id'])
+        return (client for client in clients if self.matches(client, 'client_id', hosts, health_filter))
+
+    def get_volumes(self, names=None, health_filter=None, layouts=False, stream=False):
+        # The volumes without their layouts, apart from the dirty bits, unless the layouts are asked for.
+        if stream or names is not None or health_filter is not None:
+            query = ApiQuery().where('name', names).where('health', health_filter).order_by('name')
+            if not layouts:
+                query.only(VOLUME_LIST_FIELDS)
+            return self.api.iter_volumes(query)
+        return sorted(self.get('volume_layouts' if layouts else 'volumes'), key=lambda volume: volume['name'])
+
+    def get_segment_index(self):
+        # Maps every drive and every target to the volumes with segments on it and their segment and dead segment
+        # counts. Built in one pass over the volume layouts and kept until they are fetched again.
+        with self.lock:
+            volumes = self.get('volume_layouts')
+            if self.segment_index is None:
+                disk_index = {}
+                target_index = {}
+                disk_targets = {}
+                for volume in volumes:
+                    for chunk in volume.get('chunks', []):
+                        for praid in chunk['pRaids']:
+                            for segment in praid['diskSegments']:
+                                dead = 1 if segment['isDead'] is True else 0
+                                disk_targets[segment['diskID']] = segment['node_id']
+                                for counts in (disk_index.setdefault(segment['diskID'], {}),
+                                               target_index.setdefault(segment['node_id'], {})):
+                                    volume_counts = counts.setdefault(volume['name'], [0, 0])
+                                    volume_counts[0] += 1
+                                    volume_counts[1] += dead
+                self.segment_index = (disk_index, target_index, disk_targets)
+            return self.segment_index
+
+    def get_server_details(self, node_ids):
+        # The full records of the servers, with their disks and NICs, fetched at the same time for servers not seen yet.
+        with self.lock:
+            self.get('servers')
+            missing = [node_id for node_id in node_ids if node_id not in self.server_details]
+            for node_id, details in zip(missing, fetch_concurrently(
+                    lambda api, node_id: json.loads(api.get_server_by_id(node_id)), missing)):
+                self.server_details[node_id] = details
+                for disk in details.get('disks', []):
+                    self.disks_by_id[disk['diskID']] = (details, disk)
+            return [self.server_details[node_id] for node_id in node_ids]
+
+
+class ApiQuery:
+    def __init__(self):
+        self.filter = {}
+        self.sort = {}
+        self.projection = {}
+
+    def where(self, field, values):
+        if values is not None:
+            self.filter[field] = {"$in": list(values)} if isinstance(values, (list, tuple, set)) else values
+        return self
+
+    def where_host(self, field, short_names):
+        # Host names are given short but stored fully qualified, e.g. target1 matches target1.example.com
+        if short_names is not None:
+            self.filter[field] = {"$regex": "^(%s)(\\.|$)" % "|".join(re.escape(name) for name in short_names)}
+        return self
+
+    def order_by(self, field, direction=1):
+        self.sort[field] = direction
+        return self
+
+    def only(self, fields):
+        for field in fields:
+            self.projection[field] = 1
+        return self
+
+    def build(self):
+        parameters = [('filter', self.filter), ('sort', self.sort)]
+        if self.projection:
+            parameters.append(('projection', self.projection))
+        return '?' + '&'.join('%s=%s' % (name, urllib.quote(json.dumps(value, sort_keys=True, separators=(',', ':')),
+                                                            safe='')) for name, value in parameters)
+
+
+class ManagerFailover:
+    # The management servers in failover order and the one switched to last. Shared by an Api object and all its
+    # spawned copies, so a manager one of them found dead is skipped by the others as well.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.managers = []
+        self.latency = {}
+        self.server = None
+
+
 class Api:
     def __init__(self):
         self.protocol = 'https'
@@ -558,52 +1401,241 @@ class Api:
         self.password = None
         self.endpoint = None
         self.payload = None
-        self.session = requests.session()
         self.response = None
-        self.session.verify = False
         self.err = None
         self.action = None
         self.timeout = 10
+        self.session_file = os.path.expanduser('~/.nvmesh_api_session')
+        self.session_ttl = 1800
+        self.session_expiry = None
+        self.session_user = None
+        self.cache = ApiResponseCache()
+        self.failover = ManagerFailover()
+        # Background callers only log failures and failovers, nothing is printed or flagged for the running command.
+        self.quiet = False
+
+    def __getattr__(self, name):
+        # The HTTP session is created on first use, so commands that never call the API don't import requests.
+        if name != 'session':
+            raise AttributeError(name)
+        self.session = requests.session()
+        self.session.verify = False
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=settings.get('api_parallelism')))
+        return self.session
 
     def execute_api_call(self):
         try:
-            if self.action == "post":
-                logging.debug(
-                    "API action: POST %s://%s:%s%s" % (self.protocol, self.server, self.port, self.endpoint))
-                logging.debug("API payload: %s" % self.payload if '/login' not in self.endpoint else 'login')
-                if self.payload:
-                    self.response = self.session.post(
-                        '%s://%s:%s%s' % (self.protocol, self.server, self.port, self.endpoint), json=self.payload,
-                        timeout=self.timeout, verify=False)
-                else:
-                    self.response = self.session.post(
-                        '%s://%s:%s%s' % (self.protocol, self.server, self.port, self.endpoint), timeout=self.timeout)
-                    logging.debug("API response: %s" % self.response)
-                    logging.debug("API response content is: %s"
-                                  % self.response.content if '/login' not in self.endpoint else 'login')
-                return self.response.content
-            elif self.action == "get":
-                logging.debug("API action: GET %s://%s:%s%s" % (self.protocol, self.server, self.port, self.endpoint))
-                self.response = self.session.get(
-                    "%s://%s:%s%s" % (self.protocol, self.server, self.port, self.endpoint), timeout=self.timeout,
-                    verify=False)
-                logging.debug("API response status code: %s" % self.response)
-                logging.debug("API response content is: %s" % self.response.content)
-                return self.response.content
+            self.response = None
+            action, endpoint, payload = self.action, self.endpoint, self.payload
+            if action == "get":
+                cached_content = self.cache.get(self.server, endpoint)
+                if cached_content is not None:
+                    logging.debug("API cache hit: GET %s" % endpoint)
+                    return cached_content
+            try:
+                self.send_request_with_failover()
+                if self.response.status_code == 401 and '/login' not in endpoint:
+                    logging.info("API session on %s expired or was rejected, re-authenticating." % self.server)
+                    self.login()
+                    self.action, self.endpoint, self.payload = action, endpoint, payload
+                    self.send_request()
+            finally:
+                # A failed or timed out POST may still have been applied by the manager.
+                if action == "post" and '/login' not in endpoint:
+                    self.cache.invalidate(endpoint)
+            if action == "get" and self.response.status_code == 200:
+                self.cache.put(self.server, endpoint, self.response.content)
+            return self.response.content
         except Exception, e:
+            if self.quiet:
+                logging.warning("API request %s failed. %s" % (self.endpoint, e.message))
+                return
             cli_exit.error = True
             logging.critical(e.message)
             print(formatter.red("Error: " + e.message))
 
+    def send_request_with_failover(self):
+        with self.failover.lock:
+            if self.failover.server not in [None, self.server] and self.server not in self.failover.managers:
+                self.server = self.failover.server
+        failed_managers = []
+        while True:
+            try:
+                self.send_request()
+                return
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout), e:
+                # A POST that timed out after the connection was made may have been applied, so only GETs and POSTs
+                # that never reached the manager are sent again.
+                if '/login' in self.endpoint or (self.action == "post" and not is_connect_error(e)):
+                    raise
+                failed_managers.append(self.server)
+                if not self.fail_over(failed_managers):
+                    raise
+
+    def fail_over(self, failed_managers):
+        action, endpoint, payload = self.action, self.endpoint, self.payload
+        with self.failover.lock:
+            self.failover.managers = [manager for manager in self.failover.managers if manager not in failed_managers]
+            candidates = list(self.failover.managers)
+        for manager in candidates:
+            message = "Management server %s is not responding, switching to %s." % (failed_managers[-1], manager)
+            if not self.quiet:
+                print(formatter.yellow(message))
+            logging.warning(message)
+            self.server = manager
+            try:
+                self.login()
+                with self.failover.lock:
+                    self.failover.server = manager
+                self.action, self.endpoint, self.payload = action, endpoint, payload
+                return True
+            except Exception, e:
+                logging.warning("Cannot log into management server %s. %s" % (manager, e.message))
+                failed_managers.append(manager)
+        self.action, self.endpoint, self.payload = action, endpoint, payload
+        return False
+
+    def probe_manager(self, manager, endpoint='/'):
+        try:
+            start = time.time()
+            response = self.session.get('%s://%s:%s%s' % (self.protocol, manager, self.port, endpoint),
+                                        timeout=settings.get('manager_probe_timeout'), verify=False)
+            if response.status_code < 500:
+                return manager, time.time() - start
+            logging.warning("Management server %s answered the probe with %s." % (manager, response.status_code))
+        except Exception, e:
+            logging.warning("Management server %s did not answer the probe. %s" % (manager, e.message))
+        return manager, None
+
+    def probe_managers(self, manager_list, endpoint='/', store=True):
+        # Probes all managers at once, so a manager that is down costs one probe timeout instead of one per manager.
+        # With store the managers that answered become the failover order, otherwise they are only returned.
+        if len(manager_list) < 2:
+            probe_results = [self.probe_manager(manager, endpoint) for manager in manager_list]
+        else:
+            thread_pool = ThreadPool(len(manager_list))
+            try:
+                probe_results = thread_pool.map(lambda manager: self.probe_manager(manager, endpoint), manager_list)
+            finally:
+                thread_pool.close()
+        latency = dict((manager, manager_latency) for manager, manager_latency in probe_results
+                       if manager_latency is not None)
+        managers = sorted(latency, key=latency.get)
+        if not store:
+            return managers
+        with self.failover.lock:
+            self.failover.latency = latency
+            self.failover.managers = managers
+        logging.debug("Management server latency: %s" % ", ".join(
+            "%s %.1f ms" % (manager, latency[manager] * 1000) for manager in managers))
+        return list(managers)
+
+    def send_request(self):
+        if self.action == "post":
+            logging.debug(
+                "API action: POST %s://%s:%s%s" % (self.protocol, self.server, self.port, self.endpoint))
+            logging.debug("API payload: %s" % self.payload if '/login' not in self.endpoint else 'login')
+            if self.payload:
+                self.response = self.session.post(
+                    '%s://%s:%s%s' % (self.protocol, self.server, self.port, self.endpoint), json=self.payload,
+                    timeout=self.timeout, verify=False)
+            else:
+                self.response = self.session.post(
+                    '%s://%s:%s%s' % (self.protocol, self.server, self.port, self.endpoint), timeout=self.timeout)
+                logging.debug("API response: %s" % self.response)
+                logging.debug("API response content is: %s"
+                              % self.response.content if '/login' not in self.endpoint else 'login')
+        elif self.action == "get":
+            logging.debug("API action: GET %s://%s:%s%s" % (self.protocol, self.server, self.port, self.endpoint))
+            self.response = self.session.get(
+                "%s://%s:%s%s" % (self.protocol, self.server, self.port, self.endpoint), timeout=self.timeout,
+                verify=False)
+            logging.debug("API response status code: %s" % self.response)
+            logging.debug("API response content is: %s" % self.response.content)
+
     def login(self):
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        self.session.cookies.clear()
+        self.session_expiry = None
         self.action = "post"
         self.endpoint = '/login'
         self.payload = {
             "username": self.user_name,
             "password": self.password
         }
-        return self.execute_api_call()
+        # Sent directly, so a rejected login only raises and the caller decides whether that's an error.
+        self.response = None
+        self.send_request()
+        if self.response.status_code != 200:
+            raise Exception("Login to the management server %s failed!" % self.server)
+        self.session_user = self.user_name
+        self.session_expiry = time.time() + self.session_ttl
+        for cookie in self.session.cookies:
+            if cookie.expires:
+                self.session_expiry = min(self.session_expiry, cookie.expires)
+        self.save_session()
+        return self.response.content
+
+    def is_authenticated(self):
+        return self.server is not None and self.session_expiry is not None and self.session_user == self.user_name \
+            and time.time() < self.session_expiry
+
+    def save_session(self):
+        try:
+            session_data = json.dumps({"server": self.server,
+                                       "user": self.session_user,
+                                       "expiry": self.session_expiry,
+                                       "managers": [[manager, self.failover.latency.get(manager)]
+                                                    for manager in self.failover.managers],
+                                       "cookies": requests.utils.dict_from_cookiejar(self.session.cookies)})
+            session_file = os.fdopen(os.open(self.session_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w')
+            os.chmod(self.session_file, 0o600)
+            session_file.write(session_data)
+            session_file.close()
+        except Exception, e:
+            logging.warning("Cannot save the API session. %s" % e.message)
+
+    def load_session(self, manager_list):
+        try:
+            if not os.path.isfile(self.session_file):
+                return False
+            session_data = json.loads(open(self.session_file, 'r').read())
+            if session_data["user"] != self.user_name or session_data["server"] not in manager_list \
+                    or session_data["expiry"] <= time.time():
+                return False
+            self.server = session_data["server"]
+            self.session_user = session_data["user"]
+            self.session_expiry = session_data["expiry"]
+            stored_managers = [manager for manager in session_data.get("managers", []) if manager[0] in manager_list]
+            with self.failover.lock:
+                self.failover.latency = dict(manager for manager in stored_managers if manager[1] is not None)
+                self.failover.managers = [manager[0] for manager in stored_managers] or \
+                    [self.server] + [manager for manager in manager_list if manager != self.server]
+            self.session.cookies.clear()
+            requests.utils.add_dict_to_cookiejar(self.session.cookies, session_data["cookies"])
+            logging.debug("Reusing the stored API session on %s" % self.server)
+            return True
+        except Exception, e:
+            logging.warning("Cannot load the stored API session. %s" % e.message)
+            return False
+
+    def spawn(self):
+        # Request state lives on the instance, so concurrent callers each need their own Api object. The shallow copy
+        # shares the HTTP session, its keep-alive connection pool and the response cache. The session is created
+        # before copying, so that all copies share the same one.
+        getattr(self, 'session')
+        return copy.copy(self)
+
+    def clear_session(self):
+        self.session_expiry = None
+        self.session_user = None
+        with self.failover.lock:
+            self.failover.managers = []
+            self.failover.latency = {}
+            self.failover.server = None
+        self.session.cookies.clear()
+        if os.path.isfile(self.session_file):
+            os.remove(self.session_file)
 
     def get_cluster(self):
         self.endpoint = '/status'
@@ -615,20 +1647,32 @@ class Api:
         self.action = "get"
         return self.execute_api_call()
 
-    def get_servers(self):
-        self.endpoint = '/servers/all/%s/%s' % (0, 0)
-        self.action = "get"
-        return self.execute_api_call()
+    def iter_pages(self, collection, query):
+        # Walks a collection page by page, so only one page of records is decoded and held in memory at a time.
+        page_size = settings.get('api_page_size')
+        page = 0
+        while True:
+            self.endpoint = '%s/%s/%s%s' % (collection, page, page_size, query)
+            self.action = "get"
+            records = json.loads(self.execute_api_call())
+            for record in records:
+                yield record
+            if page_size == 0 or len(records) < page_size:
+                return
+            page += 1
 
-    def get_clients(self):
-        self.endpoint = '/clients/all/%s/%s' % (0, 0)
-        self.action = "get"
-        return self.execute_api_call()
+    def iter_servers(self, query=None):
+        return self.iter_pages('/servers/all', query.build() if query else '')
 
-    def get_volumes(self):
-        self.endpoint = '/volumes/all/%s/%s' % (0, 0)
-        self.action = "get"
-        return self.execute_api_call()
+    def iter_clients(self, query=None):
+        return self.iter_pages('/clients/all', query.build() if query else '')
+
+    def iter_volumes(self, query=None):
+        return self.iter_pages('/volumes/all', query.build() if query else '')
+
+    def iter_logs(self, all_logs):
+        return self.iter_pages('/logs/all' if all_logs else '/logs/alerts',
+                               ApiQuery().order_by('timestamp', -1).build())
 
     def get_volume(self, volume_id):
         self.endpoint = '/volumes/all/%s/%s?filter={"_id":"%s"}&sort={}' % (0, 0, volume_id)
@@ -640,21 +1684,13 @@ class Api:
         self.action = "get"
         return self.execute_api_call()
 
-    def get_logs(self, all_logs):
-        if all_logs:
-            self.endpoint = '/logs/all/0/0?filter={}&sort={"timestamp":-1}'
-        else:
-            self.endpoint = '/logs/alerts/0/0?filter={}&sort={"timestamp":-1}'
-        self.action = "get"
-        return self.execute_api_call()
-
-    def get_vpgs(self):
-        self.endpoint = '/volumeProvisioningGroups/all'
+    def get_vpgs(self, query=None):
+        self.endpoint = '/volumeProvisioningGroups/all' + (query.build() if query else '')
         self.action = "get"
         return self.execute_api_call()
 
-    def get_disk_classes(self):
-        self.endpoint = '/diskClasses/all'
+    def get_disk_classes(self, query=None):
+        self.endpoint = '/diskClasses/all' + (query.build() if query else '')
         self.action = "get"
         return self.execute_api_call()
 
@@ -679,8 +1715,8 @@ class Api:
         self.action = "get"
         return self.execute_api_call()
 
-    def get_target_classes(self):
-        self.endpoint = '/serverClasses/all'
+    def get_target_classes(self, query=None):
+        self.endpoint = '/serverClasses/all' + (query.build() if query else '')
         self.action = "get"
         return self.execute_api_call()
 
@@ -782,23 +1818,33 @@ class Exit:
 
 formatter = OutputFormatter()
 user = UserCredentials()
+settings = Settings()
 nvmesh = Api()
+cluster_snapshot = ClusterSnapshot(nvmesh)
 mgmt = ManagementServer()
 hosts = Hosts()
 cli_exit = Exit()
+ssh_pool = SSHConnectionPool()
+ssh_event_loop = SSHEventLoop()
+ssh_executor = None
 
 
 class NvmeshShell(Cmd):
 
     def __init__(self):
-        Cmd.__init__(self, use_ipython=True)
+        Cmd.__init__(self, use_ipython=False)
         self.hidden_commands = ['py', 'ipy', 'pyscript', '_relative_load', 'eof', 'eos', 'exit']
 
+    def postcmd(self, stop, line):
+        notify_agent_of_changes()
+        return stop
+
     prompt = "\033[1;34mnvmesh #\033[0m "
     show_parser = argparse.ArgumentParser(formatter_class=ArgsUsageOutputFormatter)
     show_parser.add_argument('nvmesh_object', choices=['cluster', 'target', 'client', 'volume', 'drive', 'manager',
                                                        'sshuser', 'apiuser', 'vpg', 'driveclass', 'targetclass',
-                                                       'host', 'log', 'drivemodel', 'version', 'license'],
+                                                       'host', 'log', 'drivemodel', 'version', 'license',
+                                                       'setting'],
                              help='The NVMesh object you want to list or view.')
     show_parser.add_argument('-a', '--all', required=False, action='store_const', const=True, default=False,
                              help='Show all logs. Per default only alerts are shown.')
@@ -820,6 +1866,12 @@ class NvmeshShell(Cmd):
                              help='View a single NVMesh volume or a list of volumes.')
     show_parser.add_argument('-p', '--vpg', nargs='+', required=False,
                              help='View a single or a list of NVMesh volume provisioning groups.')
+    show_parser.add_argument('-H', '--health', nargs=1, required=False, choices=['healthy', 'alarm', 'critical'],
+                             help='Only show targets, clients or volumes in the given health state.')
+    show_parser.add_argument('--no-cache', required=False, action='store_const', const=True, default=False,
+                             help='Ignore cached API responses and fetch fresh data from the management server.')
+    show_parser.add_argument('--volumes', required=False, action='store_const', const=True, default=False,
+                             help='Show the volumes with segments on each drive or target.')
 
     @with_argparser(show_parser)
     @with_category("NVMesh Resource Management")
@@ -829,24 +1881,35 @@ class NvmeshShell(Cmd):
         properties of only one or just a few you need to use the '-s' or '--server' option to specify single or a list
         of servers/targets. E.g. 'list targets -s target1 target2'"""
         user.get_api_user()
-        if args.nvmesh_object == 'target':
+        if args.no_cache:
+            nvmesh.cache.clear()
+        if args.volumes and args.nvmesh_object in ['target', 'drive']:
+            self.poutput(show_hosted_volumes(args.nvmesh_object,
+                                             args.tsv,
+                                             args.json,
+                                             args.server,
+                                             args.short_name))
+        elif args.nvmesh_object == 'target':
             self.poutput(show_target(args.detail,
                                      args.tsv,
                                      args.json,
                                      args.server,
-                                     args.short_name))
+                                     args.short_name,
+                                     args.health))
         elif args.nvmesh_object == 'client':
-            self.poutput(show_clients(args.tsv,
-                                      args.json,
-                                      args.server,
-                                      args.short_name))
+            self.poutput_stream(show_clients(args.tsv,
+                                             args.json,
+                                             args.server,
+                                             args.short_name,
+                                             args.health))
         elif args.nvmesh_object == 'volume':
-            self.poutput(show_volumes(args.detail,
-                                      args.tsv,
-                                      args.json,
-                                      args.volume,
-                                      args.short_name,
-                                      args.layout))
+            self.poutput_stream(show_volumes(args.detail,
+                                             args.tsv,
+                                             args.json,
+                                             args.volume,
+                                             args.short_name,
+                                             args.layout,
+                                             args.health))
         elif args.nvmesh_object == 'sshuser':
             self.poutput(user.get_ssh_user()[0])
         elif args.nvmesh_object == 'apiuser':
@@ -883,6 +1946,8 @@ class NvmeshShell(Cmd):
             self.poutput(": ".join(["Nvmesh CLI version", __version__]))
         elif args.nvmesh_object == 'license':
             self.ppaged(__license__)
+        elif args.nvmesh_object == 'setting':
+            self.poutput(show_settings())
         cli_exit.validate_exit()
 
     add_parser = argparse.ArgumentParser(formatter_class=ArgsUsageOutputFormatter)
@@ -1060,28 +2125,25 @@ class NvmeshShell(Cmd):
                     self.poutput(formatter.yellow("Count too high! The max is 100."))
                     return
                 else:
-                    count = 1
-                    while count <= int(args.count[0]):
-                        name = "".join([args.name[0], "%03d" % (count,)])
-                        count = count + 1
-                        self.poutput(manage_volume('create',
-                                                   name,
-                                                   args.size,
-                                                   args.description,
-                                                   args.drive_class,
-                                                   args.target_class,
-                                                   args.limit_by_target,
-                                                   args.limit_by_disk,
-                                                   args.domain,
-                                                   args.raid_level,
-                                                   args.stripe_width,
-                                                   args.vpg,
-                                                   None,
-                                                   args.parity,
-                                                   args.node_redundancy))
+                    self.poutput(manage_volume('create',
+                                               ["".join([args.name[0], "%03d" % (count,)])
+                                                for count in range(1, int(args.count[0]) + 1)],
+                                               args.size,
+                                               args.description,
+                                               args.drive_class,
+                                               args.target_class,
+                                               args.limit_by_target,
+                                               args.limit_by_disk,
+                                               args.domain,
+                                               args.raid_level,
+                                               args.stripe_width,
+                                               args.vpg,
+                                               None,
+                                               args.parity,
+                                               args.node_redundancy))
             else:
                 self.poutput(manage_volume('create',
-                                           args.name[0],
+                                           [args.name[0]],
                                            args.size,
                                            args.description,
                                            args.drive_class,
@@ -1247,6 +2309,7 @@ class NvmeshShell(Cmd):
                     return
         elif args.nvmesh_object == 'drive':
             if args.drive:
+                self.poutput(simulate_impact(drives=args.drive))
                 self.poutput(manage_drive('delete', args.drive, None))
             else:
                 cli_exit.error = True
@@ -1294,9 +2357,9 @@ class NvmeshShell(Cmd):
             volume_list = get_volume_list()
         else:
             volume_list = args.volume
-        self.poutput(attach_detach_volumes('attach',
-                                           client_list,
-                                           volume_list))
+        self.poutput_stream(attach_detach_volumes('attach',
+                                                  client_list,
+                                                  volume_list))
         cli_exit.validate_exit()
 
     detach_parser = argparse.ArgumentParser(formatter_class=ArgsUsageOutputFormatter)
@@ -1319,9 +2382,9 @@ class NvmeshShell(Cmd):
             volume_list = get_volume_list()
         else:
             volume_list = args.volume
-        self.poutput(attach_detach_volumes('detach',
-                                           client_list,
-                                           volume_list))
+        self.poutput_stream(attach_detach_volumes('detach',
+                                                  client_list,
+                                                  volume_list))
         cli_exit.validate_exit()
 
     check_parser = argparse.ArgumentParser(formatter_class=ArgsUsageOutputFormatter)
@@ -1334,6 +2397,9 @@ class NvmeshShell(Cmd):
                                    'content when piping into a grep or similar')
     check_parser.add_argument('-P', '--parallel', required=False, action='store_const', const=True, default=True,
                               help='Check the hosts/servers in parallel.')
+    check_parser.add_argument('-S', '--sort', required=False, action='store_const', const=True, default=False,
+                              help='Print the host results sorted by host name once all hosts have answered, instead '
+                                   'of as they complete.')
     check_parser.add_argument('-s', '--server', nargs='+', required=False,
                               help='Specify a single or a space separated list of managers, targets or clients.')
 
@@ -1347,33 +2413,37 @@ class NvmeshShell(Cmd):
         user.get_api_user()
         action = "check"
         if args.nvmesh_object == 'target':
-            self.poutput(manage_nvmesh_service('target',
-                                               args.detail,
-                                               args.server,
-                                               action,
-                                               args.prefix,
-                                               args.parallel,
-                                               False))
+            self.poutput_stream(manage_nvmesh_service('target',
+                                                      args.detail,
+                                                      args.server,
+                                                      action,
+                                                      args.prefix,
+                                                      args.parallel,
+                                                      False,
+                                                      sort=args.sort))
         elif args.nvmesh_object == 'client':
-            self.poutput(manage_nvmesh_service('client',
-                                               args.detail,
-                                               args.server,
-                                               action,
-                                               args.prefix,
-                                               args.parallel,
-                                               False))
+            self.poutput_stream(manage_nvmesh_service('client',
+                                                      args.detail,
+                                                      args.server,
+                                                      action,
+                                                      args.prefix,
+                                                      args.parallel,
+                                                      False,
+                                                      sort=args.sort))
         elif args.nvmesh_object == 'manager':
-            self.poutput(manage_nvmesh_service('mgr',
-                                               args.detail,
-                                               args.server,
-                                               action,
-                                               args.prefix,
-                                               args.parallel,
-                                               False))
+            self.poutput_stream(manage_nvmesh_service('mgr',
+                                                      args.detail,
+                                                      args.server,
+                                                      action,
+                                                      args.prefix,
+                                                      args.parallel,
+                                                      False,
+                                                      sort=args.sort))
         elif args.nvmesh_object == 'cluster':
             manage_cluster(args.detail,
                            action,
-                           args.prefix)
+                           args.prefix,
+                           args.sort)
         cli_exit.validate_exit()
 
     stop_parser = argparse.ArgumentParser(formatter_class=ArgsUsageOutputFormatter)
@@ -1389,6 +2459,9 @@ class NvmeshShell(Cmd):
                                   'content when piping into a grep or similar')
     stop_parser.add_argument('-P', '--parallel', required=False, action='store_const', const=True, default=True,
                              help='Stop the NVMesh services in parallel.')
+    stop_parser.add_argument('-S', '--sort', required=False, action='store_const', const=True, default=False,
+                             help='Print the host results sorted by host name once all hosts have answered, instead '
+                                  'of as they complete.')
     stop_parser.add_argument('-s', '--server', nargs='+', required=False,
                              help='Specify a single or a space separated list of managers, targets or clients.')
     stop_parser.add_argument('-y', '--yes', required=False, action='store_const', const=True,
@@ -1404,73 +2477,84 @@ class NvmeshShell(Cmd):
         user.get_api_user()
         action = "stop"
         if args.nvmesh_object == 'target':
+            self.poutput(simulate_impact(targets=args.server))
             if args.yes:
-                self.poutput(manage_nvmesh_service('target',
-                                                   args.detail,
-                                                   args.server,
-                                                   action,
-                                                   args.prefix,
-                                                   args.parallel, (False if args.graceful[0] == "False" else True)))
+                self.poutput_stream(manage_nvmesh_service('target',
+                                                          args.detail,
+                                                          args.server,
+                                                          action,
+                                                          args.prefix,
+                                                          args.parallel,
+                                                          (False if args.graceful[0] == "False" else True),
+                                                          sort=args.sort))
             else:
                 if "y" in raw_input(WARNINGS['stop_nvmesh_target']).lower():
-                    self.poutput(manage_nvmesh_service('target',
-                                                       args.detail,
-                                                       args.server,
-                                                       action,
-                                                       args.prefix,
-                                                       args.parallel, (False if args.graceful[0] == "False" else True)))
+                    self.poutput_stream(manage_nvmesh_service('target',
+                                                              args.detail,
+                                                              args.server,
+                                                              action,
+                                                              args.prefix,
+                                                              args.parallel,
+                                                              (False if args.graceful[0] == "False" else True),
+                                                              sort=args.sort))
                 else:
                     return
         elif args.nvmesh_object == 'client':
             if args.yes:
-                self.poutput(manage_nvmesh_service('client',
-                                                   args.detail,
-                                                   args.server,
-                                                   action,
-                                                   args.prefix,
-                                                   args.parallel,
-                                                   False))
+                self.poutput_stream(manage_nvmesh_service('client',
+                                                          args.detail,
+                                                          args.server,
+                                                          action,
+                                                          args.prefix,
+                                                          args.parallel,
+                                                          False,
+                                                          sort=args.sort))
             else:
                 if "y" in raw_input(WARNINGS['stop_nvmesh_client']).lower():
-                    self.poutput(manage_nvmesh_service('client',
-                                                       args.detail,
-                                                       args.server,
-                                                       action,
-                                                       args.prefix,
-                                                       args.parallel,
-                                                       False))
+                    self.poutput_stream(manage_nvmesh_service('client',
+                                                              args.detail,
+                                                              args.server,
+                                                              action,
+                                                              args.prefix,
+                                                              args.parallel,
+                                                              False,
+                                                              sort=args.sort))
                 else:
                     return
         elif args.nvmesh_object == 'manager':
             if args.yes:
-                self.poutput(manage_nvmesh_service('mgr',
-                                                   args.detail,
-                                                   args.server,
-                                                   action,
-                                                   args.prefix,
-                                                   args.parallel,
-                                                   False))
+                self.poutput_stream(manage_nvmesh_service('mgr',
+                                                          args.detail,
+                                                          args.server,
+                                                          action,
+                                                          args.prefix,
+                                                          args.parallel,
+                                                          False,
+                                                          sort=args.sort))
             else:
                 if "y" in raw_input(WARNINGS['stop_nvmesh_manager']).lower():
-                    self.poutput(manage_nvmesh_service('mgr',
-                                                       args.detail,
-                                                       args.server,
-                                                       action,
-                                                       args.prefix,
-                                                       args.parallel,
-                                                       False))
+                    self.poutput_stream(manage_nvmesh_service('mgr',
+                                                              args.detail,
+                                                              args.server,
+                                                              action,
+                                                              args.prefix,
+                                                              args.parallel,
+                                                              False,
+                                                              sort=args.sort))
                 else:
                     return
         elif args.nvmesh_object == 'cluster':
             if args.yes:
                 manage_cluster(args.detail,
                                action,
-                               args.prefix)
+                               args.prefix,
+                               args.sort)
             else:
                 if "y" in raw_input(WARNINGS['stop_cluster']).lower():
                     manage_cluster(args.detail,
                                    action,
-                                   args.prefix)
+                                   args.prefix,
+                                   args.sort)
                 else:
                     return
         elif args.nvmesh_object == 'mcm':
@@ -1487,6 +2571,9 @@ class NvmeshShell(Cmd):
                                    'content when piping into a grep or similar')
     start_parser.add_argument('-P', '--parallel', required=False, action='store_const', const=True, default=True,
                               help='Start the NVMesh services on the hosts/servers in parallel.')
+    start_parser.add_argument('-S', '--sort', required=False, action='store_const', const=True, default=False,
+                              help='Print the host results sorted by host name once all hosts have answered, instead '
+                                   'of as they complete.')
     start_parser.add_argument('-s', '--server', nargs='+', required=False,
                               help='Specify a single or a space separated list of servers.')
 
@@ -1500,33 +2587,37 @@ class NvmeshShell(Cmd):
         user.get_api_user()
         action = "start"
         if args.nvmesh_object == 'target':
-            self.poutput(manage_nvmesh_service('target',
-                                               args.detail,
-                                               args.server,
-                                               action,
-                                               args.prefix,
-                                               args.parallel,
-                                               False))
+            self.poutput_stream(manage_nvmesh_service('target',
+                                                      args.detail,
+                                                      args.server,
+                                                      action,
+                                                      args.prefix,
+                                                      args.parallel,
+                                                      False,
+                                                      sort=args.sort))
         elif args.nvmesh_object == 'client':
-            self.poutput(manage_nvmesh_service('client',
-                                               args.detail,
-                                               args.server,
-                                               action,
-                                               args.prefix,
-                                               args.parallel,
-                                               False))
+            self.poutput_stream(manage_nvmesh_service('client',
+                                                      args.detail,
+                                                      args.server,
+                                                      action,
+                                                      args.prefix,
+                                                      args.parallel,
+                                                      False,
+                                                      sort=args.sort))
         elif args.nvmesh_object == 'manager':
-            self.poutput(manage_nvmesh_service('mgr',
-                                               args.detail,
-                                               args.server,
-                                               action,
-                                               args.prefix,
-                                               args.parallel,
-                                               False))
+            self.poutput_stream(manage_nvmesh_service('mgr',
+                                                      args.detail,
+                                                      args.server,
+                                                      action,
+                                                      args.prefix,
+                                                      args.parallel,
+                                                      False,
+                                                      sort=args.sort))
         elif args.nvmesh_object == 'cluster':
             manage_cluster(args.detail,
                            action,
-                           args.prefix)
+                           args.prefix,
+                           args.sort)
         elif args.nvmesh_object == 'mcm':
             manage_mcm(args.server,
                        action)
@@ -1545,6 +2636,17 @@ class NvmeshShell(Cmd):
                                      'content when piping into a grep or similar')
     restart_parser.add_argument('-P', '--parallel', required=False, action='store_const', const=True, default=True,
                                 help='Restart the NVMesh services on the hosts/servers in parallel.')
+    restart_parser.add_argument('-S', '--sort', required=False, action='store_const', const=True, default=False,
+                                help='Print the host results sorted by host name once all hosts have answered, instead '
+                                     'of as they complete.')
+    restart_parser.add_argument('-R', '--rolling', nargs=1, required=False, type=int,
+                                help='Restart the targets or clients this many hosts at a time and wait for all '
+                                     'volumes to be healthy and in sync before the next batch. Stops at the first '
+                                     'failure.')
+    restart_parser.add_argument('-A', '--aware', required=False, action='store_const', const=True, default=False,
+                                help='Restart the targets in batches planned from the awareness domains, the volume '
+                                     'protection levels and the volume layout, so that no volume loses more segments '
+                                     'than it can tolerate. Combine with -R to limit the batch size.')
     restart_parser.add_argument('-s', '--server', nargs='+', required=False,
                                 help='Specify a single or a space separated list of servers.')
     restart_parser.add_argument('-y', '--yes', required=False, action='store_const', const=True,
@@ -1559,62 +2661,80 @@ class NvmeshShell(Cmd):
         user.get_ssh_user()
         user.get_api_user()
         action = 'restart'
+        if (args.rolling is not None or args.aware) and args.nvmesh_object in ['target', 'client']:
+            if args.yes or "y" in raw_input(WARNINGS['stop_nvmesh_%s' % args.nvmesh_object]).lower():
+                self.poutput_stream(rolling_restart(args.nvmesh_object,
+                                                    args.server,
+                                                    args.detail,
+                                                    args.prefix,
+                                                    max(args.rolling[0], 1) if args.rolling is not None else None,
+                                                    args.aware and args.nvmesh_object == 'target'))
+            cli_exit.validate_exit()
+            return
         if args.nvmesh_object == 'target':
             if args.yes:
-                self.poutput(manage_nvmesh_service('target',
-                                                   args.detail,
-                                                   args.server,
-                                                   action,
-                                                   args.prefix,
-                                                   args.parallel, (False if args.graceful[0] == "False" else True)))
+                self.poutput_stream(manage_nvmesh_service('target',
+                                                          args.detail,
+                                                          args.server,
+                                                          action,
+                                                          args.prefix,
+                                                          args.parallel,
+                                                          (False if args.graceful[0] == "False" else True),
+                                                          sort=args.sort))
             else:
                 if "y" in raw_input(WARNINGS['stop_nvmesh_target']).lower():
-                    self.poutput(manage_nvmesh_service('target',
-                                                       args.detail,
-                                                       args.server,
-                                                       action,
-                                                       args.prefix,
-                                                       args.parallel, (False if args.graceful[0] == "False" else True)))
+                    self.poutput_stream(manage_nvmesh_service('target',
+                                                              args.detail,
+                                                              args.server,
+                                                              action,
+                                                              args.prefix,
+                                                              args.parallel,
+                                                              (False if args.graceful[0] == "False" else True),
+                                                              sort=args.sort))
                 else:
                     return
         elif args.nvmesh_object == 'client':
             if args.yes:
-                self.poutput(manage_nvmesh_service('client',
-                                                   args.detail,
-                                                   args.server,
-                                                   action,
-                                                   args.prefix,
-                                                   args.parallel,
-                                                   False))
+                self.poutput_stream(manage_nvmesh_service('client',
+                                                          args.detail,
+                                                          args.server,
+                                                          action,
+                                                          args.prefix,
+                                                          args.parallel,
+                                                          False,
+                                                          sort=args.sort))
             else:
                 if "y" in raw_input(WARNINGS['stop_nvmesh_client']).lower():
-                    self.poutput(manage_nvmesh_service('client',
-                                                       args.detail,
-                                                       args.server,
-                                                       action,
-                                                       args.prefix,
-                                                       args.parallel,
-                                                       False))
+                    self.poutput_stream(manage_nvmesh_service('client',
+                                                              args.detail,
+                                                              args.server,
+                                                              action,
+                                                              args.prefix,
+                                                              args.parallel,
+                                                              False,
+                                                              sort=args.sort))
                 else:
                     return
         elif args.nvmesh_object == 'manager':
             if args.yes:
-                self.poutput(manage_nvmesh_service('mgr',
-                                                   args.detail,
-                                                   args.server,
-                                                   action,
-                                                   args.prefix,
-                                                   args.parallel,
-                                                   False))
+                self.poutput_stream(manage_nvmesh_service('mgr',
+                                                          args.detail,
+                                                          args.server,
+                                                          action,
+                                                          args.prefix,
+                                                          args.parallel,
+                                                          False,
+                                                          sort=args.sort))
             else:
                 if "y" in raw_input(WARNINGS['stop_nvmesh_manager']).lower():
-                    self.poutput(manage_nvmesh_service('mgr',
-                                                       args.detail,
-                                                       args.server,
-                                                       action,
-                                                       args.prefix,
-                                                       args.parallel,
-                                                       False))
+                    self.poutput_stream(manage_nvmesh_service('mgr',
+                                                              args.detail,
+                                                              args.server,
+                                                              action,
+                                                              args.prefix,
+                                                              args.parallel,
+                                                              False,
+                                                              sort=args.sort))
                 else:
                     return
         elif args.nvmesh_object == 'mcm':
@@ -1623,12 +2743,17 @@ class NvmeshShell(Cmd):
         elif args.nvmesh_object == 'cluster':
             manage_cluster(args.detail,
                            action,
-                           args.prefix)
+                           args.prefix,
+                           args.sort)
         cli_exit.validate_exit()
 
     define_parser = argparse.ArgumentParser(formatter_class=ArgsUsageOutputFormatter)
-    define_parser.add_argument('nvmesh_object', choices=['manager', 'sshuser', 'apiuser'],
+    define_parser.add_argument('nvmesh_object', choices=['manager', 'sshuser', 'apiuser', 'setting'],
                                help='Specify the NVMesh shell runtime variable you want to define.')
+    define_parser.add_argument('-n', '--name', nargs=1, required=False,
+                               help='The name of the shell setting to define. Use "show setting" to list them.')
+    define_parser.add_argument('-V', '--value', nargs=1, required=False,
+                               help='The new value of the shell setting.')
 
     @with_argparser(define_parser)
     @with_category("NVMesh Resource Management")
@@ -1644,13 +2769,28 @@ class NvmeshShell(Cmd):
             else:
                 user.save_ssh_sudo(False)
             user.save_ssh_user()
+            ssh_pool.close_all()
         elif args.nvmesh_object == 'apiuser':
             user.API_user_name = raw_input("Please provide a administrative API user name: ")
             user.API_password = getpass.getpass("Please provide the API password: ")
             user.save_api_user()
+            nvmesh.clear_session()
         elif args.nvmesh_object == 'manager':
             ManagementServer().save_management_server(raw_input(
                 "Provide a space separated list, min. one, of the NVMesh manager server name/s: ").split(" "))
+            nvmesh.clear_session()
+        elif args.nvmesh_object == 'setting':
+            if args.name is None or args.value is None or args.name[0] not in SETTINGS_DEFAULTS:
+                print(formatter.yellow("Use the -n and -V arguments to provide a valid setting name and its value. "
+                                       "Available settings: %s" % ", ".join(sorted(SETTINGS_DEFAULTS))))
+                cli_exit.error = True
+            else:
+                try:
+                    settings.save(args.name[0], args.value[0])
+                except ValueError, e:
+                    print(formatter.red("%s is not a valid value for %s! %s" % (args.value[0], args.name[0],
+                                                                                 e.message)))
+                    cli_exit.error = True
         cli_exit.validate_exit()
 
     runcmd_parser = argparse.ArgumentParser(formatter_class=ArgsUsageOutputFormatter)
@@ -1664,6 +2804,9 @@ class NvmeshShell(Cmd):
                                     'content when piping into a grep or similar tasks.')
     runcmd_parser.add_argument('-P', '--parallel', required=False, action='store_const', const=True, default=True,
                                help='Runs the remote command on the remote hosts in parallel.')
+    runcmd_parser.add_argument('-S', '--sort', required=False, action='store_const', const=True, default=False,
+                               help='Print the host results sorted by host name once all hosts have answered, instead '
+                                    'of as they complete.')
     runcmd_parser.add_argument('-s', '--server', nargs='+', required=False,
                                help='Specify list of servers and or hosts.')
 
@@ -1674,73 +2817,60 @@ class NvmeshShell(Cmd):
         of selected servers and hosts. Excample: runcmd manager -c systemctl status mongod"""
         user.get_ssh_user()
         user.get_api_user()
-        self.poutput(self.run_command(args.command,
-                                      args.scope,
-                                      args.prefix,
-                                      args.parallel,
-                                      args.server))
+        self.poutput_stream(self.run_command(args.command,
+                                             args.scope,
+                                             args.prefix,
+                                             args.parallel,
+                                             args.server,
+                                             args.sort))
         cli_exit.validate_exit()
 
     @staticmethod
-    def run_command(command, scope, prefix, parallel, server_list):
+    def run_command(command, scope, prefix, parallel, server_list, sort):
         try:
-            host_list = []
             ssh = SSHRemoteOperations()
             command_line = " ".join(command)
-            if server_list is not None:
-                host_list = server_list
-            else:
-                if scope == 'cluster':
-                    host_list = get_target_list(short=True)
-                    host_list.extend(get_client_list(False))
-                    host_list.extend(mgmt.get_management_server_list())
-                if scope == 'target':
-                    host_list = get_target_list(short=True)
-                if scope == 'client':
-                    host_list = get_client_list(False)
-                if scope == 'manager':
-                    host_list = mgmt.get_management_server_list()
-                if scope == 'host':
-                    host_list = Hosts().manage_hosts('get', None, False)
-            host_list = set(host_list)
+            host_list = get_scope_host_list(scope, server_list)
             command_return_list = []
             if parallel is True:
-                process_pool = Pool(len(host_list))
                 parallel_execution_map = []
                 for host in host_list:
                     parallel_execution_map.append([host, command_line])
-                command_return_list = process_pool.map(run_parallel_ssh_command, parallel_execution_map)
-                process_pool.close()
+                command_return_list = iter_ssh_commands(parallel_execution_map)
             else:
                 for host in host_list:
                     command_return = ssh.return_remote_command_std_output(host, command_line)
                     if command_return:
                         command_return_list.append([host, command_return])
-            output = []
-            for command_return in command_return_list:
-                if command_return[1][0] != 0:
-                    cli_exit.error = True
-                    output_line = formatter.red(" ".join(["Return Code %s," % (
-                        command_return[1][0]), command_return[1][1]]))
-                    if prefix is True:
-                        output.append(formatter.add_line_prefix(command_return[0], output_line, True))
-                    else:
-                        output.append(output_line)
-                else:
-                    if len(command_return[1][1]) < 1:
-                        output_line = formatter.green("OK")
-                    else:
-                        output_line = command_return[1][1]
-                    if prefix is True:
-                        output.append(formatter.add_line_prefix(command_return[0], output_line, True))
-                    else:
-                        output.append(output_line)
-            return "\n".join(output)
+            if sort is True:
+                command_return_list = sorted(command_return_list)
+            return NvmeshShell.format_command_output(command_return_list, prefix)
         except Exception, e:
             print(formatter.red("Error: " + e.message))
             logging.critical(e.message)
             cli_exit.error = True
 
+    @staticmethod
+    def format_command_output(command_return_list, prefix):
+        for command_return in command_return_list:
+            if command_return[1][0] != 0:
+                cli_exit.error = True
+                output_line = formatter.red(" ".join(["Return Code %s," % (
+                    command_return[1][0]), command_return[1][1]]))
+                if prefix is True:
+                    yield formatter.add_line_prefix(command_return[0], output_line, True)
+                else:
+                    yield output_line
+            else:
+                if len(command_return[1][1]) < 1:
+                    output_line = formatter.green("OK")
+                else:
+                    output_line = command_return[1][1]
+                if prefix is True:
+                    yield formatter.add_line_prefix(command_return[0], output_line, True)
+                else:
+                    yield output_line
+
     testssh_parser = argparse.ArgumentParser(formatter_class=ArgsUsageOutputFormatter)
     testssh_parser.add_argument('-s', '--server', nargs='+', required=False,
                                 help='Specify a server or a list of servers and/or hosts.')
@@ -1752,9 +2882,93 @@ class NvmeshShell(Cmd):
         Excample: testssh -s servername"""
         ssh = SSHRemoteOperations()
         user.get_ssh_user()
-        ssh.test_ssh_connection(args.server)
+        self.poutput_stream(ssh.test_ssh_connection(args.server))
+        cli_exit.validate_exit()
+
+    distribute_parser = argparse.ArgumentParser(formatter_class=ArgsUsageOutputFormatter)
+    distribute_parser.add_argument('scope', choices=['client', 'target', 'manager', 'cluster', 'host'],
+                                   help='Specify the scope of hosts the files are copied to.')
+    distribute_parser.add_argument('-f', '--file', nargs='+', required=True,
+                                   help='The local file or space separated list of files to copy.')
+    distribute_parser.add_argument('-d', '--destination', nargs=1, required=False, default=['/tmp'],
+                                   help='The remote directory to copy the files to. The default is /tmp')
+    distribute_parser.add_argument('-r', '--relay', required=False, action='store_const', const=True, default=False,
+                                   help='Let hosts which already have the files copy them on to the remaining hosts. '
+                                        'Requires SSH key trust between the hosts. Hosts the relay fails for get the '
+                                        'files directly from this host.')
+    distribute_parser.add_argument('-s', '--server', nargs='+', required=False,
+                                   help='Specify list of servers and or hosts.')
+
+    @with_argparser(distribute_parser)
+    @with_category("NVMesh Resource Management")
+    def do_distribute(self, args):
+        """Copy files to the whole NVMesh cluster, or just the targets, clients, managers or a list of selected
+        servers and hosts, and verify their checksums. Example: distribute target -f nvmesh-target.rpm -r"""
+        user.get_ssh_user()
+        user.get_api_user()
+        for local_file in args.file:
+            if not os.path.isfile(local_file):
+                print(formatter.red("%s doesn't exist or is not a file!" % local_file))
+                cli_exit.error = True
+                cli_exit.validate_exit()
+                return
+        self.poutput_stream(distribute_files(get_scope_host_list(args.scope, args.server),
+                                             args.file,
+                                             args.destination[0].rstrip('/') or '/',
+                                             args.relay))
+        cli_exit.validate_exit()
+
+    collect_parser = argparse.ArgumentParser(formatter_class=ArgsUsageOutputFormatter)
+    collect_parser.add_argument('nvmesh_object', choices=['diag'],
+                                help='Specify the data to collect.')
+    collect_parser.add_argument('-o', '--output', nargs=1, required=False,
+                                help='The local tar archive to write. The default is a time stamped file in the '
+                                     'nvmesh_diag directory.')
+    collect_parser.add_argument('-s', '--server', nargs='+', required=False,
+                                help='Specify list of servers and or hosts. The default is all targets, clients and '
+                                     'managers.')
+
+    @with_argparser(collect_parser)
+    @with_category("NVMesh Resource Management")
+    def do_collect(self, args):
+        """Collect logs, configuration and state from all the NVMesh hosts and the management API into one local tar
+        archive, e.g. to attach it to a support case. Example: collect diag -o case_1234.tar"""
+        user.get_ssh_user()
+        user.get_api_user()
+        if args.output is not None:
+            archive_path = os.path.abspath(args.output[0])
+        else:
+            archive_path = os.path.join(SSHRemoteOperations().local_path,
+                                        "nvmesh_diag_%s.tar" % time.strftime('%Y%m%d_%H%M%S'))
+        try:
+            if not os.path.isdir(os.path.dirname(archive_path)):
+                os.makedirs(os.path.dirname(archive_path))
+        except Exception, e:
+            cli_exit.error = True
+            logging.critical(e.message)
+            print(formatter.red("Error: " + str(e)))
+            cli_exit.validate_exit()
+            return
+        self.poutput_stream(collect_diag(get_scope_host_list('cluster', args.server), archive_path))
         cli_exit.validate_exit()
 
+    agent_parser = argparse.ArgumentParser(formatter_class=ArgsUsageOutputFormatter)
+    agent_parser.add_argument('action', choices=['start', 'stop', 'status'],
+                              help='Start, stop or check the background agent.')
+    agent_parser.add_argument('-f', '--foreground', required=False, action='store_const', const=True, default=False,
+                              help='Run the agent in the foreground instead of as a background process.')
+
+    @with_argparser(agent_parser)
+    @with_category("NVMesh Resource Management")
+    def do_agent(self, args):
+        """Manage the optional background agent. While it runs, one-shot 'show', 'check', 'runcmd' and 'testssh'
+        commands run in the agent, which keeps the API session, SSH connections and cached API responses warm between
+        them. Set NVMESH_NO_AGENT to run a command in its own process anyway. Example: agent start"""
+        if args.action == 'start':
+            Agent().start(args.foreground)
+        elif send_agent_request({"action": args.action}, sys.stdout) is None:
+            print(formatter.yellow("The NVMesh agent is not running."))
+
     update_parser = argparse.ArgumentParser(formatter_class=ArgsUsageOutputFormatter)
     update_parser.add_argument('object', choices=['volume', 'driveclass', 'targetclass'],
                                help='Specify the NVMesh object to be updated.')
@@ -1843,6 +3057,7 @@ class NvmeshShell(Cmd):
     def do_evict(self, args):
         """Evict a drive in the NVMesh cluster."""
         try:
+            self.poutput(simulate_impact(drives=args.drive))
             if args.yes:
                 self.poutput(manage_drive('evict', args.drive, None))
             else:
@@ -1868,6 +3083,7 @@ class NvmeshShell(Cmd):
     def do_format(self, args):
         """Format a drive in the NVMesh cluster."""
         try:
+            self.poutput(simulate_impact(drives=args.drive))
             if args.yes:
                 self.poutput(manage_drive('format', args.drive, args.format[0]))
             else:
@@ -1878,51 +3094,318 @@ class NvmeshShell(Cmd):
             logging.critical(e.message)
             cli_exit.error = True
 
+    def poutput_stream(self, output):
+        if output is None or isinstance(output, basestring):
+            self.poutput(output)
+            return
+        try:
+            for line in output:
+                self.poutput(line)
+        except Exception, e:
+            cli_exit.error = True
+            logging.critical(e.message)
+            print(formatter.red("Error: " + e.message))
+
+    @with_category("NVMesh Resource Management")
+    def do_refresh(self, _):
+        """Drop all cached API responses of this shell session. The next command fetches fresh data from the NVMesh
+        management server."""
+        nvmesh.cache.clear()
+        self.poutput("API response cache cleared. " + formatter.green('OK'))
+
+    def do_ipy(self, _):
+        """Enter an interactive IPython shell."""
+        from IPython import embed
+        embed(banner1='Entering an embedded IPython shell type quit() or <Ctrl>-d to exit ...',
+              exit_msg='Leaving IPython, back to %s' % sys.argv[0])
+
     def do_exit(self, _):
         exit()
 
 
-def get_api_ready():
-    user.get_api_user()
-    nvmesh.user_name = user.API_user_name
-    nvmesh.password = user.API_password
-    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-    manager_list = mgmt.get_management_server_list()
-    for manager in manager_list:
-        nvmesh.server = manager.strip()
+class LeanShell:
+    # Runs the NvmeshShell commands and prints their output without setting up cmd2. Used for one-shot commands and
+    # wherever a command needs a shell only to print.
+    poutput_stream = NvmeshShell.__dict__['poutput_stream']
+    run_command = NvmeshShell.__dict__['run_command']
+
+    def poutput(self, msg, end='\n'):
+        if msg is not None and msg != '':
+            try:
+                msg_str = '{}'.format(msg)
+                sys.stdout.write(msg_str if msg_str.endswith(end) else msg_str + end)
+                sys.stdout.flush()
+            except IOError, e:
+                if e.errno != errno.EPIPE:
+                    raise
+
+    def ppaged(self, msg, end='\n'):
+        self.poutput(msg, end)
+
+
+class Agent:
+    # A background process that runs the one-shot commands of other nvmesh processes over a Unix domain socket. It keeps
+    # the API session, the SSH connections and the API response cache warm between them and refreshes the cached
+    # responses that are in use before they expire.
+    socket_file = os.path.expanduser('~/.nvmesh_agent.sock')
+    commands = ['show', 'check', 'runcmd', 'testssh']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests_served = 0
+        self.running = True
+
+    def serve(self):
+        if os.path.exists(self.socket_file):
+            os.remove(self.socket_file)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
         try:
-            nvmesh.login()
-            return 0
-        except Exception, e:
-            if len(manager_list) < 2:
-                message = "\n".join(["Cannot log into management server %s!" % manager.strip(),
-                                     "Currently defined servers in the cli tool:",
-                                     "\n".join(sorted(open(ManagementServer().server_file).read().splitlines()))])
-                logging.critical("\n".join([message, str(e.message)]))
-                print(formatter.red(message))
-                cli_exit.error = True
-                cli_exit.validate_exit()
-                return 1
+            server.bind(self.socket_file)
+        finally:
+            os.umask(old_umask)
+        server.listen(16)
+        server.settimeout(1)
+        refresher = threading.Thread(target=self.refresh_cache)
+        refresher.daemon = True
+        refresher.start()
+        logging.info("NVMesh agent listening on %s" % self.socket_file)
+        try:
+            while self.running:
+                try:
+                    connection = server.accept()[0]
+                except socket.timeout:
+                    continue
+                handler = threading.Thread(target=self.handle, args=(connection,))
+                handler.daemon = True
+                handler.start()
+        finally:
+            server.close()
+            if os.path.exists(self.socket_file):
+                os.remove(self.socket_file)
+            logging.info("NVMesh agent stopped.")
+
+    def handle(self, connection):
+        try:
+            request = json.loads(connection.makefile('r').readline())
+            if request.get('action') == 'stop':
+                self.running = False
+                self.reply(connection, {"exit": 0, "out": "NVMesh agent stopped. %s\n" % formatter.green('OK')})
+            elif request.get('action') == 'status':
+                self.reply(connection, {"exit": 0, "out": self.get_status()})
+            elif request.get('action') == 'invalidate':
+                # Sent by nvmesh processes that changed the cluster through the API without the agent.
+                for endpoint in request['endpoints']:
+                    nvmesh.cache.invalidate(endpoint)
+                del nvmesh.cache.invalidated[:]
+                self.reply(connection, {"exit": 0})
             else:
-                if manager_list.index(manager) + 1 == len(manager_list):
-                    message = "\n".join(["Cannot log into any management server as defined in the nvmesh cli list! "
-                                         "Use 'define manager' to update and correct the list of management servers to "
-                                         "be used by the cli tool.", "Currently defined servers in the cli tool:",
-                                         "\n".join(sorted(open(ManagementServer().server_file).read().splitlines()))])
-                    logging.critical("\n".join([message, str(e.message)]))
-                    print(formatter.red(message))
-                    cli_exit.error = True
-                    cli_exit.validate_exit()
-                    return 1
-                message = "Cannot log into management server %s, Trying the next one in the list." % manager.strip()
-                print(formatter.yellow(message))
-                logging.warning("\n".join([message, str(e.message)]))
-                continue
-
+                self.reply(connection, {"exit": self.run(request['argv'], connection)})
+        except Exception, e:
+            logging.critical("NVMesh agent request failed. %s" % e)
+        finally:
+            connection.close()
 
-def show_cluster(csv_format, json_format):
-    try:
-        if get_api_ready() == 0:
+    @staticmethod
+    def reply(connection, message):
+        connection.sendall(json.dumps(message) + "\n")
+
+    def run(self, argv, connection):
+        # Commands print to sys.stdout and set the global exit state, so they run one at a time.
+        with self.lock:
+            self.requests_served += 1
+            settings.settings = None
+            cli_exit.error = None
+            del nvmesh.cache.invalidated[:]
+            output = AgentOutput(connection)
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout = sys.stderr = output
+            try:
+                run_one_shot(argv)
+                return 1 if cli_exit.error else 0
+            except SystemExit, e:
+                return e.code if isinstance(e.code, int) else 1
+            except Exception, e:
+                logging.critical(e.message)
+                output.write(formatter.red("Error: " + str(e)) + "\n")
+                return 1
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
+
+    def refresh_cache(self):
+        while self.running:
+            time.sleep(settings.get('agent_refresh_interval'))
+            interval = settings.get('agent_refresh_interval')
+            for server, endpoint in nvmesh.cache.get_expiring(interval * 2, time.time() - 300):
+                try:
+                    # Commands of clients run with sys.stdout sent to them, so the refresh must not print anything.
+                    api = nvmesh.spawn()
+                    api.quiet = True
+                    api.server = server
+                    nvmesh.cache.discard(lambda key: key == (server, endpoint))
+                    api.endpoint = endpoint
+                    api.action = "get"
+                    api.execute_api_call()
+                except Exception, e:
+                    logging.warning("NVMesh agent cannot refresh %s. %s" % (endpoint, e))
+
+    def get_status(self):
+        with nvmesh.cache.lock:
+            cache_entries, cache_size = len(nvmesh.cache.entries), nvmesh.cache.size
+        return "\n".join(["NVMesh agent running since %s, pid %s. %s" % (
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)), os.getpid(), formatter.green('OK')),
+                          "Requests served: %s" % self.requests_served,
+                          "API session: %s" % (nvmesh.server if nvmesh.is_authenticated() else "none"),
+                          "Cached API responses: %s (%s)" % (cache_entries, humanfriendly.format_size(cache_size)),
+                          "Pooled SSH connections: %s" % len(ssh_pool.connections), ""])
+
+    def start(self, foreground):
+        if send_agent_request({"action": "status"}, sys.stdout) is not None:
+            print(formatter.yellow("The NVMesh agent is already running."))
+            return
+        # Ask for missing credentials and log in now, while there is a terminal to do so.
+        user.get_ssh_user()
+        if get_api_ready() != 0:
+            return
+        if foreground:
+            self.serve()
+            return
+        if os.fork() != 0:
+            print("NVMesh agent started. %s" % formatter.green('OK'))
+            return
+        os.setsid()
+        if os.fork() != 0:
+            os._exit(0)
+        null_device = os.open(os.devnull, os.O_RDWR)
+        for file_descriptor in [0, 1, 2]:
+            os.dup2(null_device, file_descriptor)
+        try:
+            self.serve()
+        finally:
+            os._exit(0)
+
+
+class AgentOutput:
+    # Sends what a command running in the agent prints to the nvmesh process that asked for it.
+    def __init__(self, connection):
+        self.connection = connection
+
+    def write(self, text):
+        if text:
+            Agent.reply(self.connection, {"out": text})
+
+    def flush(self):
+        pass
+
+    @staticmethod
+    def isatty():
+        return False
+
+
+def send_agent_request(request, output):
+    # Sends a request to the agent and writes the output of the command to output. Returns the exit code, or None if no
+    # agent is running.
+    if not os.path.exists(Agent.socket_file):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(Agent.socket_file)
+    except socket.error:
+        client.close()
+        return None
+    try:
+        client.sendall(json.dumps(request) + "\n")
+        for line in client.makefile('r'):
+            message = json.loads(line)
+            if 'out' in message:
+                output.write(message['out'].encode('utf-8'))
+                output.flush()
+            if 'exit' in message:
+                return message['exit']
+        return 1
+    finally:
+        client.close()
+
+
+def notify_agent_of_changes():
+    # Changes made without the agent have to drop the responses it has cached for later commands as well.
+    if not nvmesh.cache.invalidated:
+        return
+    try:
+        send_agent_request({"action": "invalidate", "endpoints": list(nvmesh.cache.invalidated)}, sys.stdout)
+    except Exception, e:
+        logging.warning("Cannot tell the NVMesh agent to drop its cached API responses. %s" % e)
+    del nvmesh.cache.invalidated[:]
+
+
+def run_one_shot(argv):
+    # Runs a command given on the command line with the argument parser of its do_ method. Returns False for commands
+    # that aren't NvmeshShell commands, e.g. the cmd2 built-ins, which then need the full shell.
+    command = NvmeshShell.__dict__.get('do_%s' % argv[0]) if argv else None
+    if command is None or argv[0] in ['ipy', 'py', 'pyscript']:
+        return False
+    command(LeanShell(), " ".join(pipes.quote(argument) for argument in argv[1:]))
+    return True
+
+
+def connect_api():
+    # Logs into the first management server that answers. Returns False if there is none, without flagging an error.
+    user.get_api_user()
+    nvmesh.user_name = user.API_user_name
+    nvmesh.password = user.API_password
+    if nvmesh.is_authenticated():
+        return True
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    manager_list = [manager.strip() for manager in mgmt.get_management_server_list()]
+    if nvmesh.load_session(manager_list):
+        return True
+    healthy_managers = nvmesh.probe_managers(manager_list)
+    for manager in healthy_managers:
+        nvmesh.server = manager
+        try:
+            nvmesh.login()
+            return True
+        except Exception, e:
+            message = "Cannot log into management server %s." % manager
+            if manager != healthy_managers[-1]:
+                message += " Trying the next one in the list."
+                print(formatter.yellow(message))
+            logging.warning("\n".join([message, str(e.message)]))
+    return False
+
+
+def get_api_ready():
+    if connect_api():
+        return 0
+    manager_list = [manager.strip() for manager in mgmt.get_management_server_list()]
+    if len(manager_list) < 2:
+        message = "\n".join(["Cannot log into management server %s!" % "".join(manager_list),
+                             "Currently defined servers in the cli tool:",
+                             "\n".join(sorted(open(ManagementServer().server_file).read().splitlines()))])
+    else:
+        message = "\n".join(["Cannot log into any management server as defined in the nvmesh cli list! "
+                             "Use 'define manager' to update and correct the list of management servers to "
+                             "be used by the cli tool.", "Currently defined servers in the cli tool:",
+                             "\n".join(sorted(open(ManagementServer().server_file).read().splitlines()))])
+    logging.critical(message)
+    print(formatter.red(message))
+    cli_exit.error = True
+    cli_exit.validate_exit()
+    return 1
+
+
+def is_connect_error(error):
+    # True if the request never reached the manager, e.g. connection refused or no route to the host.
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def show_cluster(csv_format, json_format):
+    try:
+        if get_api_ready() == 0:
             cluster_json = json.loads(nvmesh.get_cluster())
             capacity_json = json.loads(nvmesh.get_space_allocation())
             total_server = cluster_json['servers']['totalServers']
@@ -1956,57 +3439,57 @@ def show_cluster(csv_format, json_format):
         print(formatter.red("Error: " + e.message))
 
 
-def show_target(details, csv_format, json_format, server, short):
+def show_target(details, csv_format, json_format, server, short, health_filter):
     try:
         if get_api_ready() == 0:
-            target_json = json.loads(nvmesh.get_servers())
+            target_json = list(cluster_snapshot.get_servers(server, health_filter))
             target_list = []
+            if details is True:
+                node_ids = [target['node_id'] for target in target_json]
+                server_details_map = dict(zip(node_ids, get_servers_by_id(node_ids)))
             for target in target_json:
-                if server is not None and target['node_id'].split('.')[0] not in server:
-                    continue
+                if short is True:
+                    target_name = target['node_id'].split('.')[0]
                 else:
-                    if short is True:
-                        target_name = target['node_id'].split('.')[0]
-                    else:
-                        target_name = target['node_id']
-                    target_disk_list = []
-                    target_nic_list = []
-                    if target["health"] == "healthy":
-                        health = formatter.green(formatter.bold("Healthy ")) + u'\u2705'
-                    else:
-                        health = formatter.red(formatter.bold("Critical ")) + u'\u274C'
-                    for disk in target['disks']:
-                        target_disk_list.append(disk['diskID'])
-                    if details is True:
-                        server_details = json.loads(nvmesh.get_server_by_id(target['node_id']))
-                        for nic in server_details['nics']:
-                            if nic['status'].lower() == "ok":
-                                nic_status = formatter.green("OK")
-                            elif nic['status'].lower() == "missing":
-                                nic_status = formatter.red("Missing!")
-                            else:
-                                nic_status = formatter.red("Error!")
-                            if 'mtu' in nic:
-                                mtu = nic['mtu']
-                            else:
-                                mtu = "n/a"
-                            if 'deviceType' in nic:
-                                device = nic['deviceType']
-                            else:
-                                device = "n/a"
-
-                            target_nic_list.append([nic['nicID'], nic_status, nic['protocol'], mtu, device])
-
-                        target_list.append([target_name,
-                                            health, target['version'],
-                                            ' '.join(target_disk_list),
-                                            format_smart_table(target_nic_list, ["NIC ID",
-                                                                                 "Status",
-                                                                                 "Protocol",
-                                                                                 "MTU",
-                                                                                 "Device"])])
-                    else:
-                        target_list.append([target_name, health, target['version']])
+                    target_name = target['node_id']
+                target_disk_list = []
+                target_nic_list = []
+                if target["health"] == "healthy":
+                    health = formatter.green(formatter.bold("Healthy ")) + u'\u2705'
+                else:
+                    health = formatter.red(formatter.bold("Critical ")) + u'\u274C'
+                for disk in target['disks']:
+                    target_disk_list.append(disk['diskID'])
+                if details is True:
+                    server_details = server_details_map[target['node_id']]
+                    for nic in server_details['nics']:
+                        if nic['status'].lower() == "ok":
+                            nic_status = formatter.green("OK")
+                        elif nic['status'].lower() == "missing":
+                            nic_status = formatter.red("Missing!")
+                        else:
+                            nic_status = formatter.red("Error!")
+                        if 'mtu' in nic:
+                            mtu = nic['mtu']
+                        else:
+                            mtu = "n/a"
+                        if 'deviceType' in nic:
+                            device = nic['deviceType']
+                        else:
+                            device = "n/a"
+
+                        target_nic_list.append([nic['nicID'], nic_status, nic['protocol'], mtu, device])
+
+                    target_list.append([target_name,
+                                        health, target['version'],
+                                        ' '.join(target_disk_list),
+                                        format_smart_table(target_nic_list, ["NIC ID",
+                                                                             "Status",
+                                                                             "Protocol",
+                                                                             "MTU",
+                                                                             "Device"])])
+                else:
+                    target_list.append([target_name, health, target['version']])
             if details is True:
                 if csv_format is True:
                     return formatter.print_tsv(target_list)
@@ -2035,12 +3518,31 @@ def show_target(details, csv_format, json_format, server, short):
         print(formatter.red("Error: " + e.message))
 
 
+def fetch_concurrently(function, items):
+    # Runs function(api, item) for all items on a bounded number of threads and returns the results in item order.
+    items = list(items)
+    if len(items) < 2:
+        return [function(nvmesh, item) for item in items]
+    thread_pool = ThreadPool(min(settings.get('api_parallelism'), len(items)))
+    try:
+        return thread_pool.map(lambda item: function(nvmesh.spawn(), item), items)
+    finally:
+        thread_pool.close()
+
+
+def get_servers_by_id(node_ids):
+    return cluster_snapshot.get_server_details(node_ids)
+
+
+def show_settings():
+    return format_smart_table(settings.list_settings(), ['Setting', 'Value', 'Default', 'Description'])
+
+
 def get_target_list(short):
     try:
         if get_api_ready() == 0:
-            target_json = json.loads(nvmesh.get_servers())
             target_list = []
-            for target in target_json:
+            for target in cluster_snapshot.get_servers():
                 if short:
                     target_list.append(target['node_id'].split('.')[0])
                 else:
@@ -2055,9 +3557,8 @@ def get_target_list(short):
 def get_client_list(full):
     try:
         if get_api_ready() == 0:
-            clients_json = json.loads(nvmesh.get_clients())
             client_list = []
-            for client in clients_json:
+            for client in cluster_snapshot.get_clients():
                 if full is True:
                     client_list.append(client['client_id'])
                 else:
@@ -2072,9 +3573,8 @@ def get_client_list(full):
 def get_volume_list():
     try:
         if get_api_ready() == 0:
-            volume_json = json.loads(nvmesh.get_volumes())
             volume_list = []
-            for volume in volume_json:
+            for volume in cluster_snapshot.get_volumes():
                 volume_list.append(volume['_id'].split('.')[0])
             return volume_list
     except Exception, e:
@@ -2087,8 +3587,7 @@ def get_drive_class_list():
     try:
         if get_api_ready() == 0:
             drive_class_list = []
-            drive_class_json = json.loads(nvmesh.get_disk_classes())
-            for drive_class in drive_class_json:
+            for drive_class in cluster_snapshot.get('drive_classes'):
                 drive_class_list.append(drive_class["_id"])
             return drive_class_list
     except Exception, e:
@@ -2101,8 +3600,7 @@ def get_target_class_list():
     try:
         if get_api_ready() == 0:
             target_class_list = []
-            target_class_json = json.loads(nvmesh.get_target_classes())
-            for target_class in target_class_json:
+            for target_class in cluster_snapshot.get('target_classes'):
                 target_class_list.append(target_class["_id"])
             return target_class_list
     except Exception, e:
@@ -2115,8 +3613,7 @@ def show_manager():
     try:
         if get_api_ready() == 0:
             manager_list = []
-            manager_json = json.loads(nvmesh.get_managers())
-            for manager in manager_json:
+            for manager in cluster_snapshot.get('managers'):
                 manager_list.append([
                     manager["hostname"],
                     manager["ip"],
@@ -2144,8 +3641,7 @@ def get_manager_list(short):
     try:
         if get_api_ready() == 0:
             manager_list = []
-            manager_json = json.loads(nvmesh.get_managers())
-            for manager in manager_json:
+            for manager in cluster_snapshot.get('managers'):
                 if short:
                     manager_list.append(manager["hostname"].split(".")[0])
                 else:
@@ -2157,32 +3653,37 @@ def get_manager_list(short):
         print(formatter.red("Error: " + e.message))
 
 
-def show_clients(csv_format, json_format, server, short):
+def get_client_rows(clients_json, server, short, health_filter):
+    for client in clients_json:
+        if server is not None and client['client_id'].split('.')[0] not in server:
+            continue
+        elif health_filter is not None and client['health'] not in health_filter:
+            continue
+        else:
+            volume_list = []
+            if client["health"] == "healthy":
+                health = formatter.green(formatter.bold("Healthy ")) + u'\u2705'
+            else:
+                health = formatter.red(formatter.bold("Critical ")) + u'\u274C'
+            if short is True:
+                client_name = client['client_id'].split('.')[0]
+            else:
+                client_name = client['client_id']
+            for volume in client['block_devices']:
+                if volume['vol_status'] == 4:
+                    volume_list.append(volume['name'])
+            yield [client_name, health, client['version'], ' '.join(sorted(set(volume_list)))]
+
+
+def show_clients(csv_format, json_format, server, short, health_filter):
     try:
         if get_api_ready() == 0:
-            clients_json = json.loads(nvmesh.get_clients())
-            client_list = []
-            for client in clients_json:
-                if server is not None and client['client_id'].split('.')[0] not in server:
-                    continue
-                else:
-                    volume_list = []
-                    if client["health"] == "healthy":
-                        health = formatter.green(formatter.bold("Healthy ")) + u'\u2705'
-                    else:
-                        health = formatter.red(formatter.bold("Critical ")) + u'\u274C'
-                    if short is True:
-                        client_name = client['client_id'].split('.')[0]
-                    else:
-                        client_name = client['client_id']
-                    for volume in client['block_devices']:
-                        if volume['vol_status'] == 4:
-                            volume_list.append(volume['name'])
-                    client_list.append(
-                        [client_name, health, client['version'], ' '.join(sorted(set(volume_list)))])
+            client_list = get_client_rows(cluster_snapshot.get_clients(server, health_filter, csv_format is True),
+                                          server, short, health_filter)
             if csv_format is True:
-                return formatter.print_tsv(client_list)
-            elif json_format is True:
+                return formatter.stream_tsv(client_list)
+            client_list = list(client_list)
+            if json_format is True:
                 return formatter.print_json(client_list)
             else:
                 return format_smart_table(sorted(client_list),
@@ -2196,166 +3697,177 @@ def show_clients(csv_format, json_format, server, short):
         print(formatter.red("Error: " + e.message))
 
 
-def show_volumes(details, csv_format, json_format, volumes, short, layout):
-    try:
-        if get_api_ready() == 0:
-            volumes_json = json.loads(nvmesh.get_volumes())
-            volumes_list = []
-            for volume in volumes_json:
-                remaining_dirty_bits = 0
-                name = formatter.bold(volume["name"])
-                if volume["health"] == "healthy":
-                    health = formatter.green(formatter.bold("Healthy"))
-                    status = formatter.green(formatter.bold(volume["status"].capitalize()))
-                elif volume["health"] == "alarm":
-                    health = formatter.yellow(formatter.bold("Alarm"))
-                    status = formatter.yellow(formatter.bold(volume["status"].capitalize()))
+def get_volume_rows(volumes_json, details, volumes, short, layout, health_filter):
+    for volume in volumes_json:
+        remaining_dirty_bits = 0
+        name = formatter.bold(volume["name"])
+        if volume["health"] == "healthy":
+            health = formatter.green(formatter.bold("Healthy"))
+            status = formatter.green(formatter.bold(volume["status"].capitalize()))
+        elif volume["health"] == "alarm":
+            health = formatter.yellow(formatter.bold("Alarm"))
+            status = formatter.yellow(formatter.bold(volume["status"].capitalize()))
+        else:
+            health = formatter.red(formatter.bold("Critical"))
+            status = formatter.red(formatter.bold(volume["status"].capitalize()))
+
+        if volumes is not None and volume['name'] not in volumes:
+            continue
+        elif health_filter is not None and volume['health'] not in health_filter:
+            continue
+        else:
+            if 'stripeWidth' in volume:
+                stripe_width = volume['stripeWidth']
+            else:
+                stripe_width = None
+            if 'domain' in volume:
+                awareness_domain = volume['domain']
+            else:
+                awareness_domain = None
+            if 'serverClasses' in volume:
+                if len(volume['serverClasses']) > 0:
+                    target_classes_list = volume['serverClasses']
                 else:
-                    health = formatter.red(formatter.bold("Critical"))
-                    status = formatter.red(formatter.bold(volume["status"].capitalize()))
+                    target_classes_list = None
+            else:
+                target_classes_list = None
 
-                if volumes is not None and volume['name'] not in volumes:
-                    continue
+            if 'diskClasses' in volume:
+                if len(volume['diskClasses']) > 0:
+                    drive_classes_list = volume['diskClasses']
                 else:
-                    if 'stripeWidth' in volume:
-                        stripe_width = volume['stripeWidth']
-                    else:
-                        stripe_width = None
-                    if 'domain' in volume:
-                        awareness_domain = volume['domain']
-                    else:
-                        awareness_domain = None
-                    if 'serverClasses' in volume:
-                        if len(volume['serverClasses']) > 0:
-                            target_classes_list = volume['serverClasses']
-                        else:
-                            target_classes_list = None
-                    else:
-                        target_classes_list = None
+                    drive_classes_list = None
+            else:
+                drive_classes_list = None
+            if 'dataBlocks' in volume:
+                data_blocks = str(volume['dataBlocks'])
+            if 'parityBlocks' in volume:
+                parity_blocks = str(volume['parityBlocks'])
+            if volume['RAIDLevel'].lower() == "erasure coding":
+                parity_info = "+".join([data_blocks, parity_blocks])
+                protection_level = volume['protectionLevel']
+                stripe_width = "n/a"
+            else:
+                parity_info = "n/a"
+                protection_level = "n/a"
 
-                    if 'diskClasses' in volume:
-                        if len(volume['diskClasses']) > 0:
-                            drive_classes_list = volume['diskClasses']
+            target_list = []
+            target_disk_list = []
+            chunk_count = 0
+            volume_layout_list = []
+
+            if layout:
+                for chunk in volume['chunks']:
+                    for praid in chunk['pRaids']:
+                        for segment in praid['diskSegments']:
+                            volume_layout_list.append([str(chunk_count),
+                                                       str(praid['stripeIndex']),
+                                                       str(segment['pRaidIndex']),
+                                                       segment['type'],
+                                                       str(segment['lbs']) if segment['lbs'] != 0 else "n/a",
+                                                       str(segment['lbe']) if segment['lbe'] != 0 else "n/a",
+                                                       u'\u274C' if segment['isDead'] is True else u'\u2705',
+                                                       segment['diskID'],
+                                                       segment['node_id']])
+                    chunk_count += 1
+
+            for chunk in volume.get('chunks', []):
+                for praid in chunk['pRaids']:
+                    for segment in praid['diskSegments']:
+                        if segment['type'] == 'raftonly':
+                            continue
                         else:
-                            drive_classes_list = None
-                    else:
-                        drive_classes_list = None
-                    if 'dataBlocks' in volume:
-                        data_blocks = str(volume['dataBlocks'])
-                    if 'parityBlocks' in volume:
-                        parity_blocks = str(volume['parityBlocks'])
-                    if volume['RAIDLevel'].lower() == "erasure coding":
-                        parity_info = "+".join([data_blocks, parity_blocks])
-                        protection_level = volume['protectionLevel']
-                        stripe_width = "n/a"
-                    else:
-                        parity_info = "n/a"
-                        protection_level = "n/a"
-
-                    target_list = []
-                    target_disk_list = []
-                    chunk_count = 0
-                    volume_layout_list = []
-
-                    if layout:
-                        for chunk in volume['chunks']:
-                            for praid in chunk['pRaids']:
-                                for segment in praid['diskSegments']:
-                                    volume_layout_list.append([str(chunk_count),
-                                                               str(praid['stripeIndex']),
-                                                               str(segment['pRaidIndex']),
-                                                               segment['type'],
-                                                               str(segment['lbs']) if segment['lbs'] != 0 else "n/a",
-                                                               str(segment['lbe']) if segment['lbe'] != 0 else "n/a",
-                                                               u'\u274C' if segment['isDead'] is True else u'\u2705',
-                                                               segment['diskID'],
-                                                               segment['node_id']])
-                            chunk_count += 1
-
-                    for chunk in volume['chunks']:
-                        for praid in chunk['pRaids']:
-                            for segment in praid['diskSegments']:
-                                if segment['type'] == 'raftonly':
-                                    continue
-                                else:
-                                    if "remainingDirtyBits" in segment:
-                                        remaining_dirty_bits = remaining_dirty_bits + segment['remainingDirtyBits']
-                                    target_disk_list.append(segment['diskID'])
-                                    if short is True:
-                                        target_list.append(segment['node_id'].split('.')[0])
-                                    else:
-                                        target_list.append(segment['node_id'])
-
-                    if details is True and not layout:
-                        volumes_list.append([name,
-                                             health,
-                                             status if remaining_dirty_bits == 0 else " ".join([
-                                                 status, str(
-                                                     100 - ((remaining_dirty_bits * 4096) * 100 / (int(volume['blocks'])
-                                                     * int(volume['blockSize'])))) + "%"]),
-                                             volume['RAIDLevel'],
-                                             parity_info,
-                                             protection_level,
-                                             humanfriendly.format_size((int(volume['blocks'])
-                                                                        * int(volume['blockSize'])), binary=True),
-                                             stripe_width if stripe_width is not None else "n/a",
-                                             humanfriendly.format_size((remaining_dirty_bits * 4096), binary=True),
-                                             ' '.join(set(target_list)),
-                                             ' '.join(set(target_disk_list)),
-                                             ' '.join(target_classes_list) if target_classes_list is not None
-                                             else "n/a",
-                                             ' '.join(drive_classes_list) if drive_classes_list is not None else "n/a",
-                                             awareness_domain if awareness_domain is not None else "n/a"])
-
-                    elif details is True and layout:
-                        volumes_list.append([name,
-                                             health,
-                                             status if remaining_dirty_bits == 0 else " ".join([
-                                                 status, str(
-                                                     100 - ((remaining_dirty_bits * 4096) * 100 / (int(volume['blocks'])
-                                                                                                   * int(
-                                                                 volume['blockSize'])))) + "%"]),
-                                             volume['RAIDLevel'],
-                                             parity_info,
-                                             protection_level,
-                                             humanfriendly.format_size((int(volume['blocks'])
-                                                                        * int(volume['blockSize'])), binary=True),
-                                             stripe_width if stripe_width is not None else "n/a",
-                                             humanfriendly.format_size((remaining_dirty_bits * 4096), binary=True),
-                                             ' '.join(set(target_list)),
-                                             ' '.join(set(target_disk_list)),
-                                             ' '.join(target_classes_list) if target_classes_list is not None
-                                             else "n/a",
-                                             ' '.join(drive_classes_list) if drive_classes_list is not None else "n/a",
-                                             awareness_domain if awareness_domain is not None else "n/a",
-                                             format_smart_table(volume_layout_list, ["Chunk",
-                                                                                     "Stripe",
-                                                                                     "Segment",
-                                                                                     "Type",
-                                                                                     "LBA Start",
-                                                                                     "LBA End",
-                                                                                     "Status",
-                                                                                     "Disk ID",
-                                                                                     "Last Known Target"])])
-                    else:
-                        volumes_list.append([name,
-                                             health,
-                                             status if remaining_dirty_bits == 0 else " ".join([
-                                                 status, str(
-                                                     100 - ((remaining_dirty_bits * 4096) * 100 / (int(volume['blocks'])
-                                                                                                   * int(
-                                                                 volume['blockSize'])))) + "%"]),
-                                             volume['RAIDLevel'],
-                                             parity_info,
-                                             protection_level,
-                                             humanfriendly.format_size((int(volume['blocks'])
-                                                                        * int(volume['blockSize'])), binary=True),
-                                             stripe_width if stripe_width is not None else "n/a",
-                                             humanfriendly.format_size((remaining_dirty_bits * 4096), binary=True)])
+                            if "remainingDirtyBits" in segment:
+                                remaining_dirty_bits = remaining_dirty_bits + segment['remainingDirtyBits']
+                            if details is not True:
+                                continue
+                            target_disk_list.append(segment['diskID'])
+                            if short is True:
+                                target_list.append(segment['node_id'].split('.')[0])
+                            else:
+                                target_list.append(segment['node_id'])
+
             if details is True and not layout:
-                if csv_format is True:
-                    return formatter.print_tsv(volumes_list)
-                elif json_format is True:
+                yield [name,
+                       health,
+                       status if remaining_dirty_bits == 0 else " ".join([
+                           status, str(
+                               100 - ((remaining_dirty_bits * 4096) * 100 / (int(volume['blocks'])
+                               * int(volume['blockSize'])))) + "%"]),
+                       volume['RAIDLevel'],
+                       parity_info,
+                       protection_level,
+                       humanfriendly.format_size((int(volume['blocks'])
+                                                  * int(volume['blockSize'])), binary=True),
+                       stripe_width if stripe_width is not None else "n/a",
+                       humanfriendly.format_size((remaining_dirty_bits * 4096), binary=True),
+                       ' '.join(set(target_list)),
+                       ' '.join(set(target_disk_list)),
+                       ' '.join(target_classes_list) if target_classes_list is not None
+                       else "n/a",
+                       ' '.join(drive_classes_list) if drive_classes_list is not None else "n/a",
+                       awareness_domain if awareness_domain is not None else "n/a"]
+
+            elif details is True and layout:
+                yield [name,
+                       health,
+                       status if remaining_dirty_bits == 0 else " ".join([
+                           status, str(
+                               100 - ((remaining_dirty_bits * 4096) * 100 / (int(volume['blocks'])
+                                                                             * int(
+                                           volume['blockSize'])))) + "%"]),
+                       volume['RAIDLevel'],
+                       parity_info,
+                       protection_level,
+                       humanfriendly.format_size((int(volume['blocks'])
+                                                  * int(volume['blockSize'])), binary=True),
+                       stripe_width if stripe_width is not None else "n/a",
+                       humanfriendly.format_size((remaining_dirty_bits * 4096), binary=True),
+                       ' '.join(set(target_list)),
+                       ' '.join(set(target_disk_list)),
+                       ' '.join(target_classes_list) if target_classes_list is not None
+                       else "n/a",
+                       ' '.join(drive_classes_list) if drive_classes_list is not None else "n/a",
+                       awareness_domain if awareness_domain is not None else "n/a",
+                       format_smart_table(volume_layout_list, ["Chunk",
+                                                               "Stripe",
+                                                               "Segment",
+                                                               "Type",
+                                                               "LBA Start",
+                                                               "LBA End",
+                                                               "Status",
+                                                               "Disk ID",
+                                                               "Last Known Target"])]
+            else:
+                yield [name,
+                       health,
+                       status if remaining_dirty_bits == 0 else " ".join([
+                           status, str(
+                               100 - ((remaining_dirty_bits * 4096) * 100 / (int(volume['blocks'])
+                                                                             * int(
+                                           volume['blockSize'])))) + "%"]),
+                       volume['RAIDLevel'],
+                       parity_info,
+                       protection_level,
+                       humanfriendly.format_size((int(volume['blocks'])
+                                                  * int(volume['blockSize'])), binary=True),
+                       stripe_width if stripe_width is not None else "n/a",
+                       humanfriendly.format_size((remaining_dirty_bits * 4096), binary=True)]
+
+
+def show_volumes(details, csv_format, json_format, volumes, short, layout, health_filter):
+    try:
+        if get_api_ready() == 0:
+            # The plain listing only needs the dirty bits out of the chunk layouts, -d and -l need all of them.
+            volumes_list = get_volume_rows(cluster_snapshot.get_volumes(volumes, health_filter,
+                                                                        details is True or layout is True,
+                                                                        csv_format is True),
+                                           details, volumes, short, layout, health_filter)
+            if csv_format is True:
+                return formatter.stream_tsv(volumes_list)
+            volumes_list = list(volumes_list)
+            if details is True and not layout:
+                if json_format is True:
                     return formatter.print_json(volumes_list)
                 else:
                     return format_smart_table(sorted(volumes_list),
@@ -2374,9 +3886,7 @@ def show_volumes(details, csv_format, json_format, volumes, short, layout):
                                                'Drive Classes',
                                                'Awareness/Domain'])
             elif details is True and layout:
-                if csv_format is True:
-                    return formatter.print_tsv(volumes_list)
-                elif json_format is True:
+                if json_format is True:
                     return formatter.print_json(volumes_list)
                 else:
                     return format_smart_table(sorted(volumes_list),
@@ -2396,9 +3906,7 @@ def show_volumes(details, csv_format, json_format, volumes, short, layout):
                                                'Awareness/Domain',
                                                'Volume Layout'])
             else:
-                if csv_format is True:
-                    return formatter.print_tsv(volumes_list)
-                elif json_format is True:
+                if json_format is True:
                     return formatter.print_json(volumes_list)
                 else:
                     return format_smart_table(sorted(volumes_list),
@@ -2420,7 +3928,10 @@ def show_volumes(details, csv_format, json_format, volumes, short, layout):
 def show_vpgs(csv_format, json_format, vpgs):
     try:
         if get_api_ready() == 0:
-            vpgs_json = json.loads(nvmesh.get_vpgs())
+            if vpgs is not None:
+                vpgs_json = json.loads(nvmesh.get_vpgs(ApiQuery().where('name', vpgs)))
+            else:
+                vpgs_json = cluster_snapshot.get('vpgs')
             vpgs_list = []
             for vpg in vpgs_json:
                 server_classes_list = []
@@ -2467,7 +3978,10 @@ def show_vpgs(csv_format, json_format, vpgs):
 def show_drive_classes(details, csv_format, json_format, classes):
     try:
         if get_api_ready() == 0:
-            drive_classes_json = json.loads(nvmesh.get_disk_classes())
+            if classes is not None:
+                drive_classes_json = json.loads(nvmesh.get_disk_classes(ApiQuery().where('_id', classes)))
+            else:
+                drive_classes_json = cluster_snapshot.get('drive_classes')
             drive_class_list = []
             for drive_class in drive_classes_json:
                 drive_model_list = []
@@ -2515,22 +4029,21 @@ def show_logs(all_logs):
     try:
         if get_api_ready() == 0:
             logs_list = []
-            logs_json = json.loads(nvmesh.get_logs(all_logs))
-            for log_entry in logs_json:
+            for log_entry in nvmesh.iter_logs(all_logs):
                 if log_entry["level"] == "ERROR":
                     logs_list.append(
-                        "\t".join([str(dateutil.parser.parse(log_entry["timestamp"])),
+                        "\t".join([str(dateutil_parser.parse(log_entry["timestamp"])),
                                    formatter.red(log_entry["level"]),
                                    log_entry["message"]]))
                 elif log_entry["level"] == "WARNING":
                     logs_list.append(
-                        "\t".join([str(dateutil.parser.parse(log_entry["timestamp"])),
+                        "\t".join([str(dateutil_parser.parse(log_entry["timestamp"])),
                                    formatter.yellow(log_entry["level"]),
                                    log_entry["message"]]).strip())
                 else:
                     logs_list.append(
                         "\t".join(
-                            [str(dateutil.parser.parse(log_entry["timestamp"])),
+                            [str(dateutil_parser.parse(log_entry["timestamp"])),
                              log_entry["level"],
                              log_entry["message"]]).strip())
             return "\n".join(logs_list)
@@ -2543,7 +4056,10 @@ def show_logs(all_logs):
 def show_target_classes(csv_format, json_format, classes):
     try:
         if get_api_ready() == 0:
-            target_classes_json = json.loads(nvmesh.get_target_classes())
+            if classes is not None:
+                target_classes_json = json.loads(nvmesh.get_target_classes(ApiQuery().where('_id', classes)))
+            else:
+                target_classes_json = cluster_snapshot.get('target_classes')
             target_classes_list = []
             for target_class in target_classes_json:
                 if classes is not None and target_class['_id'] not in classes:
@@ -2582,19 +4098,64 @@ def show_target_classes(csv_format, json_format, classes):
         print(formatter.red("Error: " + e.message))
 
 
-def count_active_targets():
+def get_targets_down_by_manager(target_list):
+    # The manager's view of the targets, fetched fresh from /servers/all. Targets the manager doesn't list any longer
+    # count as down. Returns None if the manager can't be asked.
     try:
-        active_targets = 0
-        for target in get_target_list(short=True):
-            ssh = SSHRemoteOperations()
-            ssh_return = ssh.return_remote_command_std_output(target, "/etc/init.d/nvmeshtarget status")
-            if ssh_return[0] == 0:
-                active_targets += 1
-        return active_targets
+        nvmesh.cache.discard(lambda key: key[1].startswith('/servers'))
+        healthy_targets = set(target['node_id'].split('.')[0] for target in nvmesh.spawn().iter_servers()
+                              if target['health'] == 'healthy')
+        return set(target for target in target_list if target not in healthy_targets)
     except Exception, e:
-        cli_exit.error = True
-        logging.critical(e.message)
-        print(formatter.red("Error: " + e.message))
+        logging.warning("Cannot get the target health from the management server. %s" % e.message)
+        return None
+
+
+def is_target_service_down(target):
+    # As in check_if_service_is_running only exit code 3 means the service is down. Any other exit code, e.g. a sudo
+    # failure, or an SSH error leaves it unknown, so the target counts as still running.
+    ssh = SSHRemoteOperations()
+    try:
+        remote_command, stdin_data = ssh.prepare_command("/etc/init.d/nvmeshtarget status")
+        exit_code = ssh.run_remote_command(target, remote_command, stdin_data)[0]
+        if exit_code not in [0, 3]:
+            logging.warning("Cannot check the target service on %s, the status exited with %s." % (target, exit_code))
+        return target, exit_code == 3
+    except Exception, e:
+        logging.warning("Cannot check the target service on %s. %s" % (target, e.message))
+        return target, False
+
+
+def wait_for_targets_down(target_list):
+    # Polls the manager for the health of all targets and confirms over SSH only the targets the manager reports as
+    # down, all at once. The poll interval grows while nothing changes and starts over once a target went down.
+    active_targets = set(target_list)
+    timeout = settings.get('graceful_stop_timeout')
+    deadline = time.time() + timeout if timeout else None
+    interval = 0.5
+    progress = ProgressLine()
+    try:
+        while active_targets:
+            progress.update("%s of %s targets still running" % (len(active_targets), len(target_list)))
+            down_by_manager = get_targets_down_by_manager(active_targets)
+            to_confirm = active_targets if down_by_manager is None else down_by_manager
+            if to_confirm:
+                confirmed_down = set(target for target, is_down in
+                                     get_ssh_executor().map(is_target_service_down, sorted(to_confirm)) if is_down)
+                for target in confirmed_down:
+                    logging.debug("Target service on %s is down." % target)
+                active_targets -= confirmed_down
+                if confirmed_down:
+                    interval = 0.5
+            if not active_targets:
+                break
+            if deadline is not None and time.time() + interval > deadline:
+                return sorted(active_targets)
+            time.sleep(interval)
+            interval = min(interval * 2, 5)
+        return []
+    finally:
+        progress.clear()
 
 
 def parse_domain_args(args_list):
@@ -2629,7 +4190,7 @@ def parse_drive_args(args_drive_list):
         print(formatter.red("Error: " + e.message))
 
 
-def manage_nvmesh_service(scope, details, servers, action, prefix, parallel, graceful):
+def manage_nvmesh_service(scope, details, servers, action, prefix, parallel, graceful, sort=False):
     output = []
     ssh = SSHRemoteOperations()
     host_list = []
@@ -2660,19 +4221,24 @@ def manage_nvmesh_service(scope, details, servers, action, prefix, parallel, gra
         cli_exit.error = True
         return
 
+    if action != "check":
+        nvmesh.cache.clear()
+
     if scope == "target":
         if action == "stop" and servers is None and graceful:
             nvmesh.target_cluster_shutdown({"control": "shutdownAll"})
             print("\n".join(["Shutting down the NVMesh target services in the cluster.", "Please wait..."]))
-            while count_active_targets() != 0:
-                time.sleep(5)
+            active_targets = wait_for_targets_down(host_list)
+            if active_targets:
+                cli_exit.error = True
+                print(" ".join(["Target services still running after %s seconds:" %
+                                settings.get('graceful_stop_timeout'), formatter.red(", ".join(active_targets))]))
+                return
             print(" ".join(["All target services shut down.", formatter.green("OK")]))
             return
 
     if parallel:
-        if host_list and len(host_list) > 0:
-            process_pool = Pool(len(set(host_list)))
-        else:
+        if not host_list:
             return
         parallel_execution_map = []
         for host in set(host_list):
@@ -2685,43 +4251,10 @@ def manage_nvmesh_service(scope, details, servers, action, prefix, parallel, gra
             elif action == "restart":
                 parallel_execution_map.append([host, "/opt/NVMesh/%s*/services/nvmesh%s restart" % (scope[0], scope)])
 
-        command_return_list = process_pool.map(run_parallel_ssh_command, parallel_execution_map)
-        process_pool.close()
-        for command_return in command_return_list:
-            try:
-                if command_return[1][0] == 0:
-                    if details is True:
-                        output.append(formatter.bold(" ".join([command_return[0],
-                                                               action.capitalize(),
-                                                               formatter.green('OK')])))
-                        if prefix is True:
-                            output.append(formatter.add_line_prefix(command_return[0], (
-                                command_return[1][1][:command_return[1][1].rfind('\n')]), True) + "\n")
-                        else:
-                            output.append((command_return[1][1][:command_return[1][1].rfind('\n')] + "\n"))
-                    else:
-                        output.append(" ".join([command_return[0],
-                                                action.capitalize(),
-                                                formatter.green('OK')]))
-                else:
-                    cli_exit.error = True
-                    if details is True:
-                        output.append(formatter.bold(" ".join([command_return[0],
-                                                               action.capitalize(),
-                                                               formatter.red('Failed')])))
-                        if prefix is True:
-                            output.append(formatter.add_line_prefix(command_return[0], (
-                                command_return[1][1]) + "\n", True))
-                        else:
-                            output.append(command_return[1][1] + "\n")
-                    else:
-                        output.append(" ".join([command_return[0],
-                                                action.capitalize(),
-                                                formatter.red('Failed')]))
-            except Exception, e:
-                logging.critical(e.message)
-                return "Error"
-        return "\n".join(output)
+        command_return_list = iter_ssh_commands(parallel_execution_map)
+        if sort is True:
+            command_return_list = sorted(command_return_list)
+        return format_service_output(command_return_list, action, details, prefix)
 
     else:
         for server in host_list:
@@ -2779,38 +4312,145 @@ def manage_nvmesh_service(scope, details, servers, action, prefix, parallel, gra
         return "\n".join(output)
 
 
+def format_service_output(command_return_list, action, details, prefix):
+    for command_return in command_return_list:
+        try:
+            if command_return[1][0] == 0:
+                if details is True:
+                    yield formatter.bold(" ".join([command_return[0],
+                                                   action.capitalize(),
+                                                   formatter.green('OK')]))
+                    if prefix is True:
+                        yield formatter.add_line_prefix(command_return[0], (
+                            command_return[1][1][:command_return[1][1].rfind('\n')]), True) + "\n"
+                    else:
+                        yield command_return[1][1][:command_return[1][1].rfind('\n')] + "\n"
+                else:
+                    yield " ".join([command_return[0],
+                                    action.capitalize(),
+                                    formatter.green('OK')])
+            else:
+                cli_exit.error = True
+                if details is True:
+                    yield formatter.bold(" ".join([command_return[0],
+                                                   action.capitalize(),
+                                                   formatter.red('Failed')]))
+                    if prefix is True:
+                        yield formatter.add_line_prefix(command_return[0], (
+                            command_return[1][1]) + "\n", True)
+                    else:
+                        yield command_return[1][1] + "\n"
+                else:
+                    yield " ".join([command_return[0],
+                                    action.capitalize(),
+                                    formatter.red('Failed')])
+        except Exception, e:
+            logging.critical(e.message)
+            yield "Error"
+            return
+
+
 def attach_detach_volumes(action, clients, volumes):
-    try:
-        process_pool = Pool(len(clients))
-        parallel_execution_map = []
-        command_return_list = []
-        if action == 'attach':
-            for client in clients:
-                command_line = " ".join(['nvmesh_attach_volumes', " ".join(volumes)])
-                parallel_execution_map.append([str(client), str(command_line)])
-            command_return_list = process_pool.map(run_parallel_ssh_command,
-                                                   parallel_execution_map)
-            process_pool.close()
-        elif action == 'detach':
-            for client in clients:
-                command_line = " ".join(['nvmesh_detach_volumes', " ".join(volumes)])
-                parallel_execution_map.append([str(client), str(command_line)])
-            command_return_list = process_pool.map(run_parallel_ssh_command,
-                                                   parallel_execution_map)
-            process_pool.close()
+    # Runs the attach or detach commands on attach_parallelism clients at a time, with at most attach_batch_size
+    # volumes per command line. A client is only reported done once the management server shows the volumes attached
+    # (vol_status 4) or gone on it, with the latency from the first command to that confirmation.
+    if not clients or not volumes:
+        return
+    batch_size = settings.get('attach_batch_size')
+    volume_batches = [volumes[index:index + batch_size] for index in range(0, len(volumes), batch_size)]
+    command = 'nvmesh_attach_volumes' if action == 'attach' else 'nvmesh_detach_volumes'
+    ssh = SSHRemoteOperations()
+    results = Queue.Queue()
+    executor = get_ssh_executor()
+    pending = deque(clients)
+    in_flight = 0
+    start_times = {}
+    unconfirmed = OrderedDict()
+    latencies = []
+    confirm = get_api_ready() == 0
+    last_poll = 0
+
+    def run_client(client):
         output = []
-        for command_return in command_return_list:
-            if command_return[0] != 0:
+        try:
+            for volume_batch in volume_batches:
+                remote_command, stdin_data = ssh.prepare_command(" ".join([command] + volume_batch))
+                exit_code, std_output, std_error = ssh.run_remote_command(client, remote_command, stdin_data)
+                output.extend(line for line in [std_output, std_error] if line)
+                if exit_code != 0:
+                    results.put((client, exit_code, "\n".join(output)))
+                    return
+            results.put((client, 0, "\n".join(output)))
+        except Exception, e:
+            results.put((client, 1, "\n".join(output + [str(e)])))
+
+    while pending or in_flight or unconfirmed:
+        while pending and in_flight < settings.get('attach_parallelism'):
+            client = pending.popleft()
+            start_times[client] = time.time()
+            in_flight += 1
+            executor.apply_async(run_client, (client,))
+        try:
+            client, exit_code, output = results.get(timeout=1 if unconfirmed else None)
+            in_flight -= 1
+            if exit_code != 0:
                 cli_exit.error = True
-            output.append(formatter.add_line_prefix(command_return[0],
-                                                    command_return[1][1],
-                                                    False))
-        return "\n".join(output)
+                yield " ".join([client, action.capitalize(), formatter.red('Failed')])
+                if output:
+                    yield formatter.add_line_prefix(client, output, False)
+            elif confirm:
+                unconfirmed[client] = time.time()
+            else:
+                latencies.append(time.time() - start_times[client])
+                yield " ".join([client, action.capitalize(), formatter.green('OK'),
+                                "(%.1fs, not confirmed)" % latencies[-1]])
+        except Queue.Empty:
+            pass
+        if not unconfirmed or time.time() - last_poll < 1:
+            continue
+        last_poll = time.time()
+        attached_volumes = get_attached_volumes(unconfirmed.keys())
+        for client, finished in unconfirmed.items():
+            if attached_volumes is not None:
+                if action == 'attach':
+                    missing = set(volumes) - attached_volumes.get(client.split('.')[0], set())
+                else:
+                    missing = set(volumes) & attached_volumes.get(client.split('.')[0], set())
+                if not missing:
+                    del unconfirmed[client]
+                    latencies.append(time.time() - start_times[client])
+                    yield " ".join([client, action.capitalize(), formatter.green('OK'), "(%.1fs)" % latencies[-1]])
+                    continue
+            else:
+                missing = set(volumes)
+            if time.time() - finished > settings.get('attach_confirm_timeout'):
+                del unconfirmed[client]
+                cli_exit.error = True
+                yield " ".join([client, action.capitalize(), formatter.yellow('Not confirmed'),
+                                "after %s seconds: %s" % (settings.get('attach_confirm_timeout'),
+                                                          " ".join(sorted(missing)))])
+    if latencies:
+        latencies.sort()
+        yield "%s %s volumes on %s clients. Latency median %.1fs, max %.1fs." % (
+            'Attached' if action == 'attach' else 'Detached', len(volumes), len(latencies),
+            latencies[len(latencies) / 2], latencies[-1])
+
+
+def get_attached_volumes(clients):
+    # Returns the names of the volumes attached to each of the clients, keyed by the short client name.
+    try:
+        nvmesh.cache.discard(lambda key: key[1].startswith('/clients'))
+        query = ApiQuery().where_host('client_id', [client.split('.')[0] for client in clients]).only(
+            ['client_id', 'block_devices.name', 'block_devices.vol_status'])
+        attached_volumes = {}
+        for client in nvmesh.spawn().iter_clients(query):
+            attached_volumes[client['client_id'].split('.')[0]] = set(volume['name'] for volume in
+                                                                      client.get('block_devices', [])
+                                                                      if volume['vol_status'] == 4)
+        return attached_volumes
     except Exception, e:
-        print(formatter.red("Error: " + e.message))
-        logging.critical(e.message)
-        cli_exit.error = True
-        cli_exit.validate_exit()
+        logging.warning("Cannot get the attached volumes from the management server. %s" % e.message)
+        return None
 
 
 def manage_mcm(clients, action):
@@ -2837,65 +4477,694 @@ def manage_mcm(clients, action):
         cli_exit.validate_exit()
 
 
-def manage_cluster(details, action, prefix):
+def manage_cluster(details, action, prefix, sort=False):
+    # Every phase runs on all its hosts at once. Instead of fixed pauses, the next phase waits until the cluster is
+    # ready for it: managers answering /status, targets reported healthy and finally no volume rebuilding.
+    shell = LeanShell()
+    timings = []
+
+    def run_phase(message, scope, phase_action, graceful):
+        print(message)
+        start = time.time()
+        shell.poutput_stream(manage_nvmesh_service(scope, details, None, phase_action, prefix, True, graceful, sort))
+        timings.append([message.rstrip(' .'), "%.1fs" % (time.time() - start)])
+
+    def wait_for(description, check):
+        print("Waiting for %s ..." % description)
+        start = time.time()
+        ready = wait_until_ready(description, check)
+        timings.append(["Waiting for %s" % description, "%.1fs" % (time.time() - start)])
+        if not ready:
+            raise Exception("Timed out after %s seconds waiting for %s." % (settings.get('readiness_timeout'),
+                                                                            description))
+
+    def start_services(manager_action):
+        manager_list = [manager.strip() for manager in mgmt.get_management_server_list()]
+        run_phase("Restarting the NVMesh managers ..." if manager_action == 'restart' else
+                  "Starting the NVMesh managers ...", 'mgr', manager_action, None)
+        wait_for("the managers to answer", lambda: are_managers_answering(manager_list))
+        run_phase("Starting the NVMesh targets ...", 'target', 'start', None)
+        target_list = get_target_list(short=True) or []
+        wait_for("the targets to be healthy", lambda: get_targets_down_by_manager(target_list) == set())
+        run_phase("Starting the NVMesh clients ...", 'client', 'start', None)
+        wait_for("the volumes to finish rebuilding", are_volumes_settled)
+
     try:
         if action == "check":
             print("Checking the NVMesh managers ...")
-            NvmeshShell().poutput(manage_nvmesh_service('mgr', details, None, action, prefix, True, None))
+            shell.poutput_stream(manage_nvmesh_service('mgr', details, None, action, prefix, True, None, sort))
             print("Checking the NVMesh targets ...")
-            NvmeshShell().poutput(manage_nvmesh_service('target', details, None, action, prefix, True, None))
+            shell.poutput_stream(manage_nvmesh_service('target', details, None, action, prefix, True, None, sort))
             print("Checking the NVMesh clients ...")
-            NvmeshShell().poutput(manage_nvmesh_service('client', details, None, action, prefix, True, None))
+            shell.poutput_stream(manage_nvmesh_service('client', details, None, action, prefix, True, None, sort))
+            return
         elif action == "start":
-            print ("Starting the NVMesh managers ...")
-            NvmeshShell().poutput(manage_nvmesh_service('mgr', details, None, action, prefix, True, None))
-            time.sleep(3)
-            print ("Starting the NVMesh targets ...")
-            NvmeshShell().poutput(manage_nvmesh_service('target', details, None, action, prefix, True, None))
-            print ("Starting the NVMesh clients ...")
-            NvmeshShell().poutput(manage_nvmesh_service('client', details, None, action, prefix, True, None))
+            start_services('start')
         elif action == "stop":
-            print ("Stopping the NVMesh clients ...")
-            NvmeshShell().poutput(manage_nvmesh_service('client', details, None, action, prefix, True, None))
-            print ("Stopping the NVMesh targets ...")
-            NvmeshShell().poutput(manage_nvmesh_service('target', details, None, action, prefix, True, True))
-            print ("Stopping the NVMesh managers ...")
-            NvmeshShell().poutput(manage_nvmesh_service('mgr', details, None, action, prefix, True, None))
+            run_phase("Stopping the NVMesh clients ...", 'client', action, None)
+            run_phase("Stopping the NVMesh targets ...", 'target', action, True)
+            run_phase("Stopping the NVMesh managers ...", 'mgr', action, None)
         elif action == "restart":
-            print ("Stopping the NVMesh clients ...")
-            NvmeshShell().poutput(manage_nvmesh_service('client', details, None, 'stop', prefix, True, None))
-            print ("Stopping the NVMesh targets ...")
-            NvmeshShell().poutput(manage_nvmesh_service('target', details, None, 'stop', prefix, True, True))
-            print ("Restarting the NVMesh managers ...")
-            NvmeshShell().poutput(manage_nvmesh_service('mgr', details, None, 'restart', prefix, True, None))
-            time.sleep(3)
-            print ("Starting the NVMesh targets ...")
-            NvmeshShell().poutput(manage_nvmesh_service('target', details, None, 'start', prefix, True, None))
-            print ("Starting the NVMesh clients ...")
-            NvmeshShell().poutput(manage_nvmesh_service('client', details, None, 'start', prefix, True, None))
+            run_phase("Stopping the NVMesh clients ...", 'client', 'stop', None)
+            run_phase("Stopping the NVMesh targets ...", 'target', 'stop', True)
+            start_services('restart')
     except Exception, e:
         print(formatter.red("Error: " + e.message))
         logging.critical(e.message)
         cli_exit.error = True
         cli_exit.validate_exit()
+    finally:
+        if timings:
+            print(format_smart_table(timings, ['Phase', 'Duration']))
 
 
-def run_parallel_ssh_command(argument):
+def wait_until_ready(description, check):
+    # Calls check() until it returns True or readiness_timeout runs out. The interval grows from 0.5s up to 5s.
+    timeout = settings.get('readiness_timeout')
+    start = time.time()
+    interval = 0.5
+    progress = ProgressLine()
+    try:
+        while True:
+            progress.update("Waiting for %s ... %.0fs" % (description, time.time() - start))
+            if check():
+                return True
+            if timeout and time.time() - start + interval > timeout:
+                return False
+            time.sleep(interval)
+            interval = min(interval * 2, 5)
+    finally:
+        progress.clear()
+
+
+def are_managers_answering(manager_list):
+    # Only polls, the failover order stays as it is while the managers come back one by one.
+    return len(nvmesh.probe_managers(manager_list, '/status', store=False)) == len(manager_list)
+
+
+def are_hosts_healthy(scope, host_list):
+    # True once the manager reports all the targets, or all the clients, of the list as connected and healthy.
+    if scope == 'target':
+        return get_targets_down_by_manager([host.split('.')[0] for host in host_list]) == set()
+    try:
+        nvmesh.cache.discard(lambda key: key[1].startswith('/clients'))
+        healthy_clients = set(client['client_id'].split('.')[0] for client in nvmesh.spawn().iter_clients()
+                              if client['health'] == 'healthy')
+        return set(host.split('.')[0] for host in host_list) <= healthy_clients
+    except Exception, e:
+        logging.warning("Cannot get the client health from the management server. %s" % e.message)
+        return False
+
+
+def rolling_restart(scope, servers, details, prefix, batch_size, aware=False):
+    # Restarts batch_size hosts at a time, or the batches of the domain aware plan. Before every batch all volumes have
+    # to be healthy and fully in sync, so protected volumes never lose more than the redundancy the batch takes away.
+    host_list = sorted(get_scope_host_list(scope, servers))
+    if aware:
+        try:
+            batches, plan_description = plan_target_batches(host_list)
+        except Exception, e:
+            cli_exit.error = True
+            logging.critical(e.message)
+            yield formatter.red("Error: Cannot plan the restart batches. %s" % e)
+            return
+        if batch_size is not None:
+            batches = [batch[index:index + batch_size] for batch in batches
+                       for index in range(0, len(batch), batch_size)]
+        yield "%s %s batches planned." % (plan_description, len(batches))
+    else:
+        batches = [host_list[index:index + (batch_size or len(host_list))]
+                   for index in range(0, len(host_list), batch_size or len(host_list) or 1)]
+    start = time.time()
+    for batch_number, batch in enumerate(batches):
+        if not wait_until_ready("the volumes to be healthy and in sync", are_volumes_healthy):
+            cli_exit.error = True
+            yield formatter.red("Aborted. The volumes didn't get healthy and in sync within %s seconds. Not "
+                                "restarted: %s" % (settings.get('readiness_timeout'),
+                                                   ", ".join(sum(batches[batch_number:], []))))
+            return
+        yield formatter.bold("Batch %s of %s: %s" % (batch_number + 1, len(batches), ", ".join(batch)))
+        nvmesh.cache.clear()
+        failed_hosts = []
+        command_return_list = iter_ssh_commands([[host, "/opt/NVMesh/%s*/services/nvmesh%s restart" % (scope[0], scope)]
+                                                 for host in batch])
+        for command_return in command_return_list:
+            if command_return[1][0] != 0:
+                failed_hosts.append(command_return[0])
+            for line in format_service_output([command_return], 'restart', details, prefix):
+                yield line
+        if failed_hosts:
+            cli_exit.error = True
+            yield formatter.red("Aborted. The restart failed on %s. Not restarted: %s" % (
+                ", ".join(failed_hosts), ", ".join(sum(batches[batch_number + 1:], [])) or "none"))
+            return
+        # Right after the restart the volumes may still look healthy, because the manager hasn't noticed the hosts
+        # yet. The volume gate of the next batch only means something once the manager has them back.
+        if not wait_until_ready("%s to rejoin" % ", ".join(batch), lambda: are_hosts_healthy(scope, batch)):
+            cli_exit.error = True
+            yield formatter.red("Aborted. The management server didn't report %s healthy within %s seconds. Not "
+                                "restarted: %s" % (", ".join(batch), settings.get('readiness_timeout'),
+                                                   ", ".join(sum(batches[batch_number + 1:], [])) or "none"))
+            return
+        elapsed = time.time() - start
+        remaining_batches = len(batches) - batch_number - 1
+        yield "%s of %s hosts restarted in %.0fs.%s" % (
+            sum(len(done_batch) for done_batch in batches[:batch_number + 1]), len(host_list), elapsed,
+            " ETA %.0fs." % (elapsed / (batch_number + 1) * remaining_batches) if remaining_batches else "")
+    if batches and not wait_until_ready("the volumes to be healthy and in sync", are_volumes_healthy):
+        cli_exit.error = True
+        yield formatter.yellow("All hosts restarted, but the volumes didn't get healthy and in sync within %s "
+                               "seconds." % settings.get('readiness_timeout'))
+
+
+def get_volume_fault_tolerance(volume):
+    # The number of data segments of a pRaid that can be down at the same time without the volume losing data access.
+    raid_level = volume.get('RAIDLevel', '').lower()
+    if raid_level == 'erasure coding':
+        return volume.get('parityBlocks', 0)
+    if 'mirror' in raid_level:
+        return volume.get('numberOfMirrors', 1)
+    return 0
+
+
+def plan_target_batches(host_list):
+    # Plans which targets can go down together. If every redundant volume has full separation on the same awareness
+    # scope, a volume has at most one copy in each domain of that scope, so the targets of one domain go down together
+    # and the domains one after another. Otherwise the targets of one domain go one at a time, but targets of
+    # different domains together. Either way a target only joins a batch if no pRaid loses more data segments than its
+    # volume tolerates, or the majority of its raft members, the data and the raft only segments together.
+    if get_api_ready() != 0:
+        raise Exception("Cannot get the awareness domains and volumes from the management server.")
+    host_domains = dict((host, {}) for host in host_list)
+    for target_class in json.loads(nvmesh.get_target_classes()):
+        for node in target_class.get('targetNodes', []):
+            for domain in target_class.get('domains', []):
+                host_domains.setdefault(node.split('.')[0], {})[domain['scope']] = domain['identifier']
+    query = ApiQuery().only(['name', 'RAIDLevel', 'parityBlocks', 'numberOfMirrors', 'protectionLevel', 'domain',
+                             'chunks.pRaids.diskSegments.type', 'chunks.pRaids.diskSegments.node_id'])
+    praid_limits = []
+    host_praids = dict((host, []) for host in host_list)
+    separation_scopes = set()
+    for volume in nvmesh.spawn().iter_volumes(query):
+        tolerance = get_volume_fault_tolerance(volume)
+        if tolerance == 0:
+            logging.warning("Volume %s has no redundancy, any of its targets going down makes it unavailable."
+                            % volume['name'])
+            continue
+        domain = volume.get('domain')
+        domain_scope = domain.get('scope') if isinstance(domain, dict) else domain
+        separation_scopes.add(domain_scope if volume.get('protectionLevel') == 2 and domain_scope else None)
+        for chunk in volume.get('chunks', []):
+            for praid in chunk['pRaids']:
+                raft_members = [segment['node_id'].split('.')[0] for segment in praid['diskSegments']]
+                data_segments = [segment['node_id'].split('.')[0] for segment in praid['diskSegments']
+                                 if segment['type'] != 'raftonly']
+                if len(raft_members) == len(data_segments):
+                    # Without raft only segments there is no witness to count, only the data limit applies.
+                    raft_members = []
+                for limit, segments in [(tolerance, data_segments), ((len(raft_members) - 1) / 2, raft_members)]:
+                    if not segments:
+                        continue
+                    praid_limits.append(limit)
+                    for host in set(segments):
+                        if host in host_praids:
+                            host_praids[host].append((len(praid_limits) - 1, segments.count(host)))
+    if len(separation_scopes) == 1 and None not in separation_scopes:
+        separation_scope = separation_scopes.pop()
+        description = "Full separation on the %s scope, the %s domains go one after another." % (
+            separation_scope, separation_scope)
+        domain_groups = OrderedDict()
+        for host in host_list:
+            domain_groups.setdefault(host_domains[host].get(separation_scope) or host, []).append(host)
+        groups = domain_groups.values()
+    else:
+        separation_scope = None
+        description = "No common full separation, the targets of a domain go one at a time."
+        groups = [host_list]
+    batches = []
+    for group in groups:
+        group_batches = []
+        for host in group:
+            for batch, load in group_batches:
+                if separation_scope is None and any(set(host_domains[host].items()) &
+                                                    set(host_domains[batch_host].items()) for batch_host in batch):
+                    continue
+                if all(load.get(praid, 0) + count <= praid_limits[praid] for praid, count in host_praids[host]):
+                    batch.append(host)
+                    for praid, count in host_praids[host]:
+                        load[praid] = load.get(praid, 0) + count
+                    break
+            else:
+                if any(count > praid_limits[praid] for praid, count in host_praids[host]):
+                    logging.warning("%s holds more segments of a pRaid than its volume tolerates." % host)
+                group_batches.append(([host], dict(host_praids[host])))
+        batches.extend(batch for batch, _ in group_batches)
+    return batches, description
+
+
+def simulate_impact(drives=None, targets=None):
+    # Works out from the volume layouts which volumes would be degraded or offline if the given drives, or the given
+    # targets, all targets if neither is given, went away, and how much data would have to be rebuilt. Only the
+    # volumes the segment index lists on them are looked at. It only warns if it can't, the command goes ahead anyway.
+    error = cli_exit.error
+    try:
+        if not connect_api():
+            return formatter.yellow("Cannot reach a management server to simulate the impact on the volumes.")
+        start = time.time()
+        disk_index, target_index, disk_targets = cluster_snapshot.get_segment_index()
+        if drives is not None:
+            drives = set(drives)
+            affected = set(name for drive in drives for name in disk_index.get(drive, {}))
+            description = "the drives"
+        else:
+            targets = set(target for target in target_index
+                          if targets is None or target in targets or target.split('.')[0] in targets)
+            affected = set(name for target in targets for name in target_index[target])
+            description = "the targets"
+        volume_list = []
+        degraded = 0
+        offline = 0
+        rebuild_size = 0
+        for volume in cluster_snapshot.get_volumes(layouts=True):
+            if volume['name'] not in affected:
+                continue
+            tolerance = get_volume_fault_tolerance(volume)
+            lost_segments = 0
+            lost_size = 0
+            is_offline = False
+            for chunk in volume.get('chunks', []):
+                for praid in chunk['pRaids']:
+                    # The raft group of a pRaid is all of its segments, the raft only ones are witnesses that make the
+                    # member count odd. Without them only the data segment limit applies.
+                    segment_count = {'data': 0, 'raftonly': 0}
+                    lost_count = {'data': 0, 'raftonly': 0}
+                    for segment in praid['diskSegments']:
+                        segment_type = 'raftonly' if segment['type'] == 'raftonly' else 'data'
+                        segment_count[segment_type] += 1
+                        if drives is not None:
+                            removed = segment['diskID'] in drives
+                        else:
+                            removed = segment['node_id'] in targets
+                        if segment['isDead'] is True:
+                            lost_count[segment_type] += 1
+                        elif removed:
+                            lost_count[segment_type] += 1
+                            if segment_type == 'data':
+                                lost_segments += 1
+                                if segment['lbe']:
+                                    block_size = cluster_snapshot.disks_by_id.get(
+                                        segment['diskID'], (None, {}))[1].get('block_size', 4096)
+                                    lost_size += (segment['lbe'] - segment['lbs'] + 1) * block_size
+                    raft_members = segment_count['data'] + segment_count['raftonly']
+                    if lost_count['data'] > tolerance or (segment_count['raftonly'] and lost_count['data'] +
+                                                          lost_count['raftonly'] > (raft_members - 1) / 2):
+                        is_offline = True
+            if is_offline:
+                offline += 1
+                impact = formatter.red("Offline")
+            elif lost_segments:
+                degraded += 1
+                rebuild_size += lost_size
+                impact = formatter.yellow("Degraded")
+            else:
+                continue
+            volume_list.append([volume['name'],
+                                volume['RAIDLevel'],
+                                impact,
+                                lost_segments,
+                                "n/a" if is_offline else humanfriendly.format_size(lost_size, binary=True)])
+        logging.debug("Simulated the impact on %s volumes in %.3fs" % (len(affected), time.time() - start))
+        if not volume_list:
+            return formatter.green("No volume would be degraded or go offline without %s." % description)
+        summary = "Without %s %s volumes would be degraded, %s would go offline and %s would have to be rebuilt." % (
+            description, degraded, offline, humanfriendly.format_size(rebuild_size, binary=True))
+        return "\n".join([format_smart_table(sorted(volume_list),
+                                             ['Volume', 'RAID Level', 'Impact', 'Lost Segments', 'Rebuild']),
+                          formatter.red(summary) if offline else formatter.yellow(summary)])
+    except Exception, e:
+        logging.warning("Cannot simulate the impact on the volumes. %s" % e.message)
+        return formatter.yellow("Cannot simulate the impact on the volumes. %s" % e.message)
+    finally:
+        cli_exit.error = error
+
+
+def are_volumes_healthy():
+    # True if all volumes are healthy and no disk segment has dirty bits left to resync.
+    try:
+        nvmesh.cache.discard(lambda key: key[1].startswith('/volumes'))
+        if get_api_ready() != 0:
+            return False
+        query = ApiQuery().only(['health', 'chunks.pRaids.diskSegments.remainingDirtyBits'])
+        for volume in nvmesh.spawn().iter_volumes(query):
+            if volume['health'] != 'healthy':
+                return False
+            for chunk in volume.get('chunks', []):
+                for praid in chunk['pRaids']:
+                    for segment in praid['diskSegments']:
+                        if segment.get('remainingDirtyBits', 0) > 0:
+                            return False
+        return True
+    except Exception, e:
+        logging.warning("Cannot get the volume health from the management server. %s" % e.message)
+        return False
+
+
+def are_volumes_settled():
+    try:
+        nvmesh.cache.discard(lambda key: key[1].startswith('/volumes'))
+        if get_api_ready() != 0:
+            return False
+        return not any('rebuild' in volume['status'].lower() for volume in nvmesh.spawn().iter_volumes())
+    except Exception, e:
+        logging.warning("Cannot get the volume status from the management server. %s" % e.message)
+        return False
+
+
+def connect_tcp(host_list, port, timeout):
+    # Opens non-blocking TCP connections to all hosts at once and waits at most timeout seconds for all of them.
+    # Returns host: (connected socket or None, connect latency, error).
+    results = {}
+    connecting = {}
+    poller = select.poll()
+    for host in host_list:
+        try:
+            address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+            sock = socket.socket(address[0], address[1], address[2])
+            sock.setblocking(0)
+            error_code = sock.connect_ex(address[4])
+            if error_code not in (0, errno.EINPROGRESS):
+                sock.close()
+                results[host] = None, None, os.strerror(error_code)
+                continue
+            connecting[sock.fileno()] = host, sock, time.time()
+            poller.register(sock, select.POLLOUT)
+        except Exception, e:
+            results[host] = None, None, str(e)
+    deadline = time.time() + timeout
+    while connecting and time.time() < deadline:
+        for fileno, _ in poller.poll(max(deadline - time.time(), 0) * 1000):
+            host, sock, start = connecting.pop(fileno)
+            poller.unregister(fileno)
+            error_code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error_code == 0:
+                results[host] = sock, time.time() - start, None
+            else:
+                sock.close()
+                results[host] = None, None, os.strerror(error_code)
+    for host, sock, _ in connecting.values():
+        sock.close()
+        results[host] = None, None, "Timed out after %s seconds." % timeout
+    return results
+
+
+def get_scope_host_list(scope, server_list):
+    host_list = []
+    if server_list is not None:
+        host_list = server_list
+    else:
+        if scope == 'cluster':
+            host_list = get_target_list(short=True)
+            host_list.extend(get_client_list(False))
+            host_list.extend(mgmt.get_management_server_list())
+        if scope == 'target':
+            host_list = get_target_list(short=True)
+        if scope == 'client':
+            host_list = get_client_list(False)
+        if scope == 'manager':
+            host_list = mgmt.get_management_server_list()
+        if scope == 'host':
+            host_list = Hosts().manage_hosts('get', None, False)
+    return set(host_list)
+
+
+def get_file_md5(local_file):
+    md5 = hashlib.md5()
+    with open(local_file, 'rb') as source:
+        for data in iter(lambda: source.read(1024 * 1024), ''):
+            md5.update(data)
+    return md5.hexdigest()
+
+
+def distribute_files(host_list, file_list, remote_path, relay):
+    # This host uploads to distribute_fanout hosts at a time. In relay mode every host that has the files passes them on
+    # to one more host at a time, so the number of sources doubles with every round.
     ssh = SSHRemoteOperations()
+    results = Queue.Queue()
+    executor = get_ssh_executor()
+    pending = deque(sorted(host_list))
+    direct_only = deque()
+    local_sources = settings.get('distribute_fanout')
+    relay_sources = []
+    in_flight = 0
+    seeded_hosts = []
+    start = time.time()
+
+    def copy_files(source_host, host):
+        copy_start = time.time()
+        try:
+            if source_host is None:
+                ssh.upload_files(host, file_list, remote_path)
+            else:
+                ssh.relay_files(source_host, host, file_list, remote_path)
+            results.put((source_host, host, None, time.time() - copy_start))
+        except Exception, e:
+            results.put((source_host, host, str(e), time.time() - copy_start))
+
+    while pending or direct_only or in_flight:
+        while local_sources > 0 and (direct_only or pending):
+            local_sources -= 1
+            in_flight += 1
+            executor.apply_async(copy_files, (None, direct_only.popleft() if direct_only else pending.popleft()))
+        while relay_sources and pending:
+            in_flight += 1
+            executor.apply_async(copy_files, (relay_sources.pop(), pending.popleft()))
+        source_host, host, error, elapsed = results.get()
+        in_flight -= 1
+        if source_host is None:
+            local_sources += 1
+        else:
+            relay_sources.append(source_host)
+        if error is not None and source_host is not None:
+            logging.warning("Relay of the files from %s to %s failed, copying them directly. %s" % (source_host, host,
+                                                                                                    error))
+            direct_only.append(host)
+        elif error is not None:
+            cli_exit.error = True
+            yield " ".join(['File transfer to %s' % host, formatter.red('Failed:'), error])
+        else:
+            seeded_hosts.append(host)
+            if relay:
+                relay_sources.append(host)
+            yield " ".join(['File transfer to %s' % host, formatter.green('OK'),
+                            "(%.1fs%s)" % (elapsed, " from %s" % source_host if source_host else "")])
+    if not seeded_hosts:
+        return
+    yield "Copied to %s hosts in %.1fs. Verifying the checksums ..." % (len(seeded_hosts), time.time() - start)
+    expected_checksums = dict(("/".join([remote_path, os.path.basename(local_file)]), get_file_md5(local_file))
+                              for local_file in file_list)
+    for host, command_return in iter_ssh_commands([[host, "md5sum %s" % " ".join(sorted(expected_checksums))]
+                                                   for host in seeded_hosts]):
+        checksums = dict(reversed(line.split(None, 1)) for line in str(command_return[1]).splitlines()
+                         if len(line.split(None, 1)) == 2)
+        if command_return[0] == 0 and all(checksums.get(remote_file) == checksum
+                                          for remote_file, checksum in expected_checksums.items()):
+            yield " ".join(['Checksums on %s' % host, formatter.green('OK')])
+        else:
+            cli_exit.error = True
+            yield " ".join(['Checksums on %s' % host, formatter.red('Failed:'),
+                            ", ".join(remote_file for remote_file, checksum in sorted(expected_checksums.items())
+                                      if checksums.get(remote_file) != checksum)])
+
+
+def collect_diag(host_list, archive_path):
+    # Collects from all hosts and the management API at the same time and yields one line per host as it finishes.
+    ssh = SSHRemoteOperations()
+    archive = DiagArchive(archive_path)
+    results = Queue.Queue()
+    executor = get_ssh_executor()
+    start = time.time()
+
+    def collect_host(host):
+        host_start = time.time()
+        try:
+            received, problems = ssh.collect_diag(host, archive, "nvmesh_diag/hosts/%s.tar.gz" % host)
+            results.put((host, received, problems, None, time.time() - host_start))
+        except Exception, e:
+            results.put((host, 0, [], str(e), time.time() - host_start))
+
+    def collect_api(api):
+        api_start = time.time()
+        problems = []
+        for name, endpoint in DIAG_API_STATE.items():
+            try:
+                api.endpoint = endpoint
+                api.action = "get"
+                archive.add("nvmesh_diag/api/%s.json" % name, api.execute_api_call() or "")
+            except Exception, e:
+                problems.append("%s: %s" % (name, e))
+        results.put(("management API", None, problems, None, time.time() - api_start))
+
+    archive.add("nvmesh_diag/README", "\n".join([
+        "NVMesh diagnostic data collected %s." % time.strftime('%Y-%m-%d %H:%M:%S %Z'),
+        "The data of every host is split into parts. Join them to get its archive, e.g.:",
+        "  cat nvmesh_diag/hosts/<host>.tar.gz.* | tar -xzf -", ""]))
+    pending = len(host_list)
     try:
-        output = ssh.return_remote_command_std_output(argument[0], argument[1])
-        if output:
-            if output[0] != 0:
+        if get_api_ready() == 0:
+            executor.apply_async(collect_api, (nvmesh.spawn(),))
+            pending += 1
+        for host in sorted(host_list):
+            executor.apply_async(collect_host, (host,))
+        while pending:
+            host, received, problems, error, elapsed = results.get()
+            pending -= 1
+            if error is not None:
                 cli_exit.error = True
-            return argument[0], output
-        else:
+                yield " ".join(['Diagnostic collection on %s' % host, formatter.red('Failed:'), error])
+            elif problems:
+                cli_exit.error = True
+                yield " ".join(['Diagnostic collection on %s' % host, formatter.yellow('Incomplete:'),
+                                ", ".join(problems)])
+            else:
+                yield " ".join(['Diagnostic collection on %s' % host, formatter.green('OK'),
+                                "(%s%.1fs)" % ("%s in " % humanfriendly.format_size(received)
+                                               if received is not None else "", elapsed)])
+    finally:
+        archive.close()
+    yield "Wrote %s to %s in %.1fs." % (humanfriendly.format_size(archive.added_bytes), archive_path,
+                                        time.time() - start)
+
+
+def get_ssh_executor():
+    # One bounded thread pool serves all remote fan-out of the session, so the number of threads and SSH connections in
+    # flight stays the same no matter how many hosts a command targets.
+    global ssh_executor
+    if ssh_executor is None or ssh_executor._processes != settings.get('ssh_parallelism'):
+        if ssh_executor is not None:
+            ssh_executor.close()
+        ssh_executor = ThreadPool(settings.get('ssh_parallelism'))
+    return ssh_executor
+
+
+def run_ssh_commands(execution_map):
+    return get_ssh_executor().map(run_parallel_ssh_command, execution_map)
+
+
+def get_parallel_ssh_result(host, output):
+    if output:
+        if output[0] != 0:
+            cli_exit.error = True
+        return host, output
+    else:
+        cli_exit.error = True
+        return host, [1, "Failed on %s" % host]
+
+
+def submit_parallel_ssh_command(argument, callback):
+    # Event loop counterpart of run_parallel_ssh_command, callback gets the same (host, output) result.
+    ssh = SSHRemoteOperations()
+    remote_command, stdin_data = ssh.prepare_command(argument[1])
+
+    def on_finished(result, error):
+        if error is not None:
+            logging.critical("Couldn't execute command %s on %s! %s" % (remote_command, argument[0], error))
             cli_exit.error = True
-            return argument[0], [1, "Failed on %s" % argument[0]]
+            callback((argument[0], [1, "Failed on %s - %s" % (argument[0], error)]))
+        else:
+            callback(get_parallel_ssh_result(argument[0], ssh.map_command_return(remote_command, result)))
+
+    ssh_event_loop.submit(argument[0], ssh.ssh_user_name, ssh.ssh_password, ssh.ssh_port, remote_command, stdin_data,
+                          on_finished)
+
+
+def iter_ssh_commands(execution_map):
+    # Yields the (host, output) results in the order the hosts finish. Hosts running longer than ssh_host_deadline are
+    # yielded as timed out and their late results are dropped.
+    results = Queue.Queue()
+    start_times = {}
+
+    def run(index, argument):
+        start_times[index] = time.time()
+        try:
+            results.put((index, run_parallel_ssh_command(argument)))
+        except BaseException, e:
+            results.put((index, (argument[0], [1, "Failed on %s - %s" % (argument[0], e)])))
+
+    def put_result(index):
+        return lambda command_return: results.put((index, command_return))
+
+    executor = get_ssh_executor()
+    for index, argument in enumerate(execution_map):
+        if settings.get('ssh_backend') == 'eventloop':
+            start_times[index] = time.time()
+            submit_parallel_ssh_command(argument, put_result(index))
+        else:
+            executor.apply_async(run, (index, argument))
+    pending = set(range(len(execution_map)))
+    failed = 0
+    progress = ProgressLine()
+    try:
+        while pending:
+            progress.update("%s done, %s failed, %s pending" % (len(execution_map) - len(pending) - failed, failed,
+                                                                  len(pending)))
+            try:
+                index, command_return = results.get(timeout=1)
+            except Queue.Empty:
+                deadline = settings.get('ssh_host_deadline')
+                timed_out = [pending_index for pending_index in pending if deadline and pending_index in start_times
+                             and time.time() - start_times[pending_index] > deadline]
+                for timed_out_index in timed_out:
+                    pending.discard(timed_out_index)
+                    failed += 1
+                    cli_exit.error = True
+                    progress.clear()
+                    yield execution_map[timed_out_index][0], [124, "Timed out after %s seconds." % deadline]
+                continue
+            if index not in pending:
+                continue
+            pending.discard(index)
+            if command_return[1][0] != 0:
+                failed += 1
+            progress.clear()
+            yield command_return
+    finally:
+        progress.clear()
+
+
+def run_parallel_ssh_command(argument):
+    try:
+        ssh = SSHRemoteOperations()
+        return get_parallel_ssh_result(argument[0], ssh.return_remote_command_std_output(argument[0], argument[1]))
     except Exception, e:
-        print(formatter.red("Error: " + e.message))
+        # Runs on an executor thread, so report the failure as this host's result instead of exiting.
         logging.critical(e.message)
         cli_exit.error = True
-        cli_exit.validate_exit()
+        return argument[0], [1, "Failed on %s - %s" % (argument[0], e.message)]
+
+
+def post_in_batches(post_function, items):
+    # Sends the items in chunks of api_batch_size through post_function, which returns one result per item of the chunk
+    # it got. Returns (item, result) pairs in item order. Items without a result count as failed.
+    batch_size = settings.get('api_batch_size') or max(len(items), 1)
+    results = []
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        try:
+            batch_results = list(post_function(batch))
+        except Exception, e:
+            cli_exit.error = True
+            logging.critical(e.message)
+            batch_results = []
+        batch_results.extend([{"success": False, "err": "No result from the management server."}] *
+                             (len(batch) - len(batch_results)))
+        results.extend(zip(batch, batch_results))
+    return results
+
+
+def parse_class_save_results(response, batch):
+    # The class save endpoint may answer a single null instead of one null per class when it created all of them.
+    results = json.loads(response)
+    return [None] * len(batch) if results is None else results
 
 
 def manage_volume(action, name, capacity, description, disk_classes, server_classes, limit_by_nodes, limit_by_disks,
@@ -2905,7 +5174,6 @@ def manage_volume(action, name, capacity, description, disk_classes, server_clas
         payload = {}
         if action == "create":
             payload = {
-                "name": name,
                 "capacity": "MAX" if str(capacity[0]).upper() == "MAX" else int(humanfriendly.parse_size(capacity[0],
                                                                                                          binary=True)),
             }
@@ -2950,43 +5218,44 @@ def manage_volume(action, name, capacity, description, disk_classes, server_clas
                     payload["stripeWidth"] = 1
             elif vpg is not None and raid_level is None:
                 payload["VPG"] = vpg[0]
-            api_payload["create"] = [payload]
-            api_payload["remove"] = []
-            api_payload["edit"] = []
-            api_return = json.loads(nvmesh.manage_volume(api_payload))
-            if api_return['create'][0]['success'] is True:
-                return " ".join(["Volume",
-                                 name,
-                                 "successfully created.",
-                                 formatter.green('OK')])
-
-            else:
-                cli_exit.error = True
-                return " ".join(["Couldn't create volume", name,
-                                 formatter.red('Failed')])
+            output = []
+            for volume, result in post_in_batches(
+                    lambda batch: json.loads(nvmesh.manage_volume({"create": batch, "remove": [], "edit": []}))[
+                        'create'],
+                    [dict(payload, name=volume_name) for volume_name in name]):
+                if result['success'] is True:
+                    output.append(" ".join(["Volume",
+                                            volume['name'],
+                                            "successfully created.",
+                                            formatter.green('OK')]))
+                else:
+                    cli_exit.error = True
+                    output.append(" ".join(["Couldn't create volume", volume['name'],
+                                            formatter.red('Failed')]))
+            return "\n".join(output)
 
         elif action == 'remove':
-            api_return = []
             output = []
-            for volume in name:
-                payload["_id"] = volume
+            remove_list = []
+            for volume_name in name:
+                payload = {"_id": volume_name}
                 if force:
                     payload["force"] = True
-                api_payload["remove"] = [payload]
-                api_payload["create"] = []
-                api_payload["edit"] = []
-                api_return.append(json.loads(nvmesh.manage_volume(api_payload)))
-            for item in api_return:
-                if item['remove'][0]['success'] is True:
+                remove_list.append(payload)
+            for volume, result in post_in_batches(
+                    lambda batch: json.loads(nvmesh.manage_volume({"create": [], "remove": batch, "edit": []}))[
+                        'remove'],
+                    remove_list):
+                if result['success'] is True:
                     output.append(" ".join(["Volume",
-                                            item['remove'][0]['id'],
+                                            volume['_id'],
                                             "successfully deleted.",
                                             formatter.green('OK')]))
                 else:
                     output.append(" ".join([formatter.red('Failed'),
-                                            "to delete", item['remove'][0]['id'],
+                                            "to delete", volume['_id'],
                                             "-",
-                                            item['remove'][0]['ex']]))
+                                            result.get('ex', result.get('err', ''))]))
                     cli_exit.error = True
             return "\n".join(output)
 
@@ -3213,6 +5482,7 @@ def manage_drive_class(action, class_list, drives, model, name, description, dom
         payload = {}
         if action == "autocreate":
             model_list = get_drive_models(pretty=False)
+            class_list = []
             for model in model_list:
                 drives = json.loads(nvmesh.get_disk_by_model(model[0]))
                 drive_list = []
@@ -3223,27 +5493,24 @@ def manage_drive_class(action, class_list, drives, model, name, description, dom
                             "node_id": drive["node_id"]
                         }
                     )
-                payload["_id"] = re.sub("(?<=_)_|_(?=_)", "", model[0])
-                payload["description"] = "automatically created"
-                payload["disks"] = [{"model": model[0],
-                                     "disks": drive_list}]
-                api_payload = [payload]
-                api_return.append([re.sub("(?<=_)_|_(?=_)",
-                                          "",
-                                          model[0]),
-                                   json.dumps(nvmesh.manage_drive_class("save",
-                                                                        api_payload))])
-            for line in api_return:
-                if "null" in line[1]:
+                class_list.append({"_id": re.sub("(?<=_)_|_(?=_)", "", model[0]),
+                                   "description": "automatically created",
+                                   "disks": [{"model": model[0],
+                                              "disks": drive_list}]})
+            for drive_class, result in post_in_batches(
+                    lambda batch: parse_class_save_results(nvmesh.manage_drive_class("save", batch), batch),
+                    class_list):
+                # The save endpoint returns null for every class it created.
+                if result is None:
                     output.append(" ".join(["Drive Class",
-                                            line[0],
+                                            drive_class["_id"],
                                             "successfully created.",
                                             formatter.green('OK')]))
                 else:
                     output.append(" ".join([formatter.red('Failed'),
                                             "\t",
                                             "Couldn't create Drive Class",
-                                            line[0],
+                                            drive_class["_id"],
                                             " - ",
                                             "Check for duplicates."]))
                     cli_exit.error = True
@@ -3279,22 +5546,21 @@ def manage_drive_class(action, class_list, drives, model, name, description, dom
             return "\n".join(output)
 
         elif action == "delete":
-            for drive_class in class_list:
-                payload = [{"_id": drive_class}]
-                return_info = json.loads(nvmesh.manage_drive_class("delete", payload))
-
-                if return_info[0]["success"] is True:
+            for drive_class, return_info in post_in_batches(
+                    lambda batch: json.loads(nvmesh.manage_drive_class("delete", batch)),
+                    [{"_id": drive_class} for drive_class in class_list]):
+                if return_info["success"] is True:
                     output.append(
                         " ".join(["Drive Class",
-                                  drive_class,
+                                  drive_class["_id"],
                                   "successfully deleted.",
                                   formatter.green('OK')]))
                 else:
                     output.append(" ".join([formatter.red('Failed'),
                                             "\t", "Couldn't delete Drive Class.",
-                                            drive_class,
+                                            drive_class["_id"],
                                             " - ",
-                                            return_info[0]["msg"]]))
+                                            return_info.get("msg", return_info.get("err"))]))
                     cli_exit.error = True
             return "\n".join(output)
 
@@ -3305,45 +5571,42 @@ def manage_target_class(action, class_list, name, servers, description, domains)
         output = []
         payload = {}
         if action == "autocreate":
-            for target in get_target_list(short=False):
-                payload["name"] = target.split(".")[0]
-                payload["targetNodes"] = [target]
-                payload["description"] = "automatically created"
-                api_payload = [payload]
-                api_return.append([target.split(".")[0],
-                                   json.dumps(nvmesh.manage_target_class("save", api_payload))])
-            for line in api_return:
-                if "null" in line[1]:
+            for target_class, result in post_in_batches(
+                    lambda batch: parse_class_save_results(nvmesh.manage_target_class("save", batch), batch),
+                    [{"name": target.split(".")[0],
+                      "targetNodes": [target],
+                      "description": "automatically created"} for target in get_target_list(short=False)]):
+                # The save endpoint returns null for every class it created.
+                if result is None:
                     output.append(" ".join(["Target Class",
-                                            line[0],
+                                            target_class["name"],
                                             "successfully created.",
                                             formatter.green('OK')]))
                 else:
                     output.append(" ".join([formatter.red('Failed'),
                                             "\t", "Couldn't create Target Class",
-                                            line[0],
+                                            target_class["name"],
                                             " - ",
                                             "Check for duplicates."]))
                     cli_exit.error = True
             return "\n".join(output)
         elif action == "delete":
-            for target_class in class_list:
-                payload = [{"_id": target_class}]
-                return_info = json.loads(nvmesh.manage_target_class("delete", payload))
-
-                if return_info[0]["success"] is True:
+            for target_class, return_info in post_in_batches(
+                    lambda batch: json.loads(nvmesh.manage_target_class("delete", batch)),
+                    [{"_id": target_class} for target_class in class_list]):
+                if return_info["success"] is True:
                     output.append(
                         " ".join(["Target Class",
-                                  target_class,
+                                  target_class["_id"],
                                   "successfully deleted.",
                                   formatter.green('OK')]))
                 else:
                     output.append(" ".join([formatter.red('Failed'),
                                             "\t",
                                             "Couldn't delete Target Class",
-                                            target_class,
+                                            target_class["_id"],
                                             " - ",
-                                            return_info[0]["msg"]]))
+                                            return_info.get("msg", return_info.get("err"))]))
                     cli_exit.error = True
             return "\n".join(output)
         elif action == "save":
@@ -3375,72 +5638,71 @@ def show_drives(details, targets, tsv):
     if get_api_ready() == 0:
         drive_list = []
         target_list = get_target_list(short=False)
-        for target in target_list:
-            if targets is not None and target.split('.')[0] not in targets:
-                continue
-            else:
-                target_details = json.loads(nvmesh.get_server_by_id(target))
-                for disk in target_details['disks']:
-                    if disk['isExcluded']:
-                        pass
+        if targets is not None:
+            target_list = [target for target in target_list if target.split('.')[0] in targets]
+        target_details_list = get_servers_by_id(target_list)
+        for target, target_details in zip(target_list, target_details_list):
+            for disk in target_details['disks']:
+                if disk['isExcluded']:
+                    pass
+                else:
+                    vendor = disk['Vendor'] if not str(disk['Vendor']).lower() in NVME_VENDORS else \
+                        NVME_VENDORS[str(disk['Vendor']).lower()]
+                    if disk["status"].lower() == "ok":
+                        status = u'\u2705'
+                    elif disk["status"].lower() == "not_initialized":
+                        status = formatter.yellow("Not Initialized")
+                        drive_format = "n/a"
+                    elif disk["status"].lower() == "initializing":
+                        status = "Initializing - %s%%" % (disk['nZeroedBlks'] * 100 / disk['availableBlocks'])
                     else:
-                        vendor = disk['Vendor'] if not str(disk['Vendor']).lower() in NVME_VENDORS else \
-                            NVME_VENDORS[str(disk['Vendor']).lower()]
-                        if disk["status"].lower() == "ok":
-                            status = u'\u2705'
-                        elif disk["status"].lower() == "not_initialized":
-                            status = formatter.yellow("Not Initialized")
-                            drive_format = "n/a"
-                        elif disk["status"].lower() == "initializing":
-                            status = "Initializing - %s%%" % (disk['nZeroedBlks'] * 100 / disk['availableBlocks'])
+                        status = u'\u274C'
+                    if 'metadata_size' in disk:
+                        if int(disk['metadata_size']) == 8:
+                            ec_support = "Yes"
                         else:
-                            status = u'\u274C'
-                        if 'metadata_size' in disk:
-                            if int(disk['metadata_size']) == 8:
-                                ec_support = "Yes"
+                            ec_support = "No"
+                    else:
+                        ec_support = "n/a"
+                    if 'metadata_size' in disk:
+                        if disk["status"].lower() != "not_initialized":
+                            if disk['metadata_size'] > 0:
+                                drive_format = "EC"
                             else:
-                                ec_support = "No"
-                        else:
-                            ec_support = "n/a"
-                        if 'metadata_size' in disk:
-                            if disk["status"].lower() != "not_initialized":
-                                if disk['metadata_size'] > 0:
-                                    drive_format = "EC"
-                                else:
-                                    drive_format = "Legacy"
-                        else:
-                            drive_format = "n/a"
-                        if 'isOutOfService' in disk:
-                            in_service = formatter.red("No")
-                            status = "n/a"
-                        else:
-                            in_service = formatter.green("Yes")
-                        if details:
-                            drive_list.append([vendor,
-                                               disk['Model'],
-                                               disk['diskID'],
-                                               humanfriendly.format_size((disk['block_size'] * disk['blocks']),
-                                                                         binary=True),
-                                               status,
-                                               in_service,
-                                               ec_support,
-                                               drive_format,
-                                               humanfriendly.format_size(disk['block_size'], binary=True),
-                                               " ".join([str(100 - int((disk['Available_Spare'].split("_")[0]))), "%"]),
-                                               target,
-                                               disk['Numa_Node'],
-                                               disk['Submission_Queues']])
-                        else:
-                            drive_list.append([vendor,
-                                               re.sub("(?<=_)_|_(?=_)", "", disk['Model']),
-                                               disk['diskID'],
-                                               humanfriendly.format_size((disk['block_size'] * disk['blocks']),
-                                                                         binary=True),
-                                               status,
-                                               in_service,
-                                               ec_support,
-                                               drive_format,
-                                               target])
+                                drive_format = "Legacy"
+                    else:
+                        drive_format = "n/a"
+                    if 'isOutOfService' in disk:
+                        in_service = formatter.red("No")
+                        status = "n/a"
+                    else:
+                        in_service = formatter.green("Yes")
+                    if details:
+                        drive_list.append([vendor,
+                                           disk['Model'],
+                                           disk['diskID'],
+                                           humanfriendly.format_size((disk['block_size'] * disk['blocks']),
+                                                                     binary=True),
+                                           status,
+                                           in_service,
+                                           ec_support,
+                                           drive_format,
+                                           humanfriendly.format_size(disk['block_size'], binary=True),
+                                           " ".join([str(100 - int((disk['Available_Spare'].split("_")[0]))), "%"]),
+                                           target,
+                                           disk['Numa_Node'],
+                                           disk['Submission_Queues']])
+                    else:
+                        drive_list.append([vendor,
+                                           re.sub("(?<=_)_|_(?=_)", "", disk['Model']),
+                                           disk['diskID'],
+                                           humanfriendly.format_size((disk['block_size'] * disk['blocks']),
+                                                                     binary=True),
+                                           status,
+                                           in_service,
+                                           ec_support,
+                                           drive_format,
+                                           target])
         if tsv:
             return formatter.print_tsv(drive_list)
         if details:
@@ -3470,6 +5732,42 @@ def show_drives(details, targets, tsv):
                                                            'Target'])
 
 
+def show_hosted_volumes(nvmesh_object, csv_format, json_format, server, short):
+    try:
+        if get_api_ready() == 0:
+            disk_index, target_index, disk_targets = cluster_snapshot.get_segment_index()
+            volume_list = []
+            if nvmesh_object == 'drive':
+                for disk_id, volumes in disk_index.items():
+                    target = disk_targets[disk_id]
+                    if server is not None and target.split('.')[0] not in server:
+                        continue
+                    for volume, (segments, dead_segments) in volumes.items():
+                        volume_list.append([disk_id, target.split('.')[0] if short is True else target, volume,
+                                            segments, dead_segments])
+                header = ['Drive ID', 'Target', 'Volume', 'Segments', 'Dead Segments']
+            else:
+                for target, volumes in target_index.items():
+                    if server is not None and target.split('.')[0] not in server:
+                        continue
+                    for volume, (segments, dead_segments) in volumes.items():
+                        volume_list.append([target.split('.')[0] if short is True else target, volume, segments,
+                                            dead_segments])
+                header = ['Target', 'Volume', 'Segments', 'Dead Segments']
+            volume_list.sort()
+            if csv_format is True:
+                return formatter.print_tsv(volume_list)
+            elif json_format is True:
+                return formatter.print_json([dict(zip(header, row)) for row in volume_list])
+            for row in volume_list:
+                row[-1] = formatter.red(" ".join([str(row[-1]), u'\u274C'])) if row[-1] > 0 else u'\u2705'
+            return format_smart_table(volume_list, header)
+    except Exception, e:
+        cli_exit.error = True
+        logging.critical(e.message)
+        print(formatter.red("Error: " + e.message))
+
+
 def show_drive_models(details):
     if not details:
         return format_smart_table(get_drive_models(pretty=True), ["Drive Model", "Drives"])
@@ -3489,22 +5787,35 @@ def get_drive_models(pretty):
         return model_list
 
 
+def get_startup_category(command_line):
+    words = command_line.split()
+    command = " ".join(words[:2])
+    category = 'api'
+    for category_name, commands in STARTUP_CATEGORIES.items():
+        if command in commands or (words or [''])[0] in commands:
+            category = category_name
+    return category
+
+
+def load_startup_modules(command_line):
+    # Loads the modules of the command's category the way running it would. Used by startup_benchmark.py.
+    for module in STARTUP_BUDGETS[get_startup_category(command_line)][1]:
+        module.load()
+    loaded = sorted(module.name for module in globals().values() if isinstance(module, LazyModule) and module.module)
+    sys.stderr.write("In process start up %.3fs, loaded on demand: %s\n" % (time.time() - STARTUP_BEGIN,
+                                                                            ", ".join(loaded) or "none"))
+
+
 def start_shell():
     reload(sys)
     sys.setdefaultencoding('utf-8')
-    history_file = os.path.expanduser('~/.nvmesh_shell_history')
-    if not os.path.exists(history_file):
-        with open(history_file, "w") as history:
-            history.write("")
-    readline.read_history_file(history_file)
-    atexit.register(readline.write_history_file, history_file)
-    shell = NvmeshShell()
+    atexit.register(ssh_pool.close_all)
     if os.path.exists(os.path.expanduser('~/.nvmesh_cli_ack')):
         pass
     else:
         print("Before using this software, please read and acknowledge the licensing terms and agreement.")
         if 'y' in raw_input("Do you want to proceed? [Yes/No]: ").lower():
-            NvmeshShell().ppaged(__license__)
+            LeanShell().ppaged(__license__)
             if 'y' in raw_input("\nDo you agree to the licensing terms? [Yes/No]: ").lower():
                 ack = open(os.path.expanduser('~/.nvmesh_cli_ack'), 'w')
                 ack.write(str(""))
@@ -3518,9 +5829,24 @@ def start_shell():
 
     if len(sys.argv) > 1:
         cli_exit.is_interactive = False
-        shell.onecmd(' '.join(sys.argv[1:]))
+        if sys.argv[1] in Agent.commands and not os.environ.get('NVMESH_NO_AGENT'):
+            exit_code = send_agent_request({"argv": sys.argv[1:]}, sys.stdout)
+            if exit_code is not None:
+                sys.exit(exit_code)
+        try:
+            if not run_one_shot(sys.argv[1:]):
+                NvmeshShell().onecmd(' '.join(sys.argv[1:]))
+        finally:
+            notify_agent_of_changes()
     else:
         cli_exit.is_interactive = True
+        shell = NvmeshShell()
+        history_file = os.path.expanduser('~/.nvmesh_shell_history')
+        if not os.path.exists(history_file):
+            with open(history_file, "w") as history:
+                history.write("")
+        readline.read_history_file(history_file)
+        atexit.register(readline.write_history_file, history_file)
         shell.cmdloop('''
 Copyright (c) 2018 Excelero, Inc. All rights reserved.
 
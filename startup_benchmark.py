@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright (c) 2018 Excelero, Inc. All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author:        Andreas Krause
+# Maintainer:    Andreas Krause
+# Email:         andreas@excelero.com
+
+# Times a fresh interpreter that imports nvmesh and loads the modules of one command of each start up category,
+# interpreter start included, and exits with 1 if any of them takes longer than its budget in nvmesh.STARTUP_BUDGETS.
+# Usage: python startup_benchmark.py [runs]
+
+import os
+import subprocess
+import sys
+import time
+
+BENCHMARK_COMMANDS = [
+    ('local', 'show version'),
+    ('api', 'show volume'),
+    ('ssh', 'check target'),
+]
+
+
+def time_command(here, command, runs):
+    # The best of a few runs, so a busy machine doesn't fail the check by chance.
+    code = "import sys; sys.path.insert(0, %r); import nvmesh; nvmesh.load_startup_modules(%r)" % (here, command)
+    timings = []
+    for run in range(runs):
+        start = time.time()
+        process = subprocess.Popen([sys.executable, '-c', code], stdin=open(os.devnull), stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        timings.append(time.time() - start)
+        if process.returncode != 0:
+            raise Exception("'%s' failed with exit code %s: %s" % (command, process.returncode, (out + err).strip()))
+    return min(timings), err.strip()
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    here = os.path.abspath(os.path.dirname(__file__))
+    sys.path.insert(0, here)
+    import nvmesh
+    exceeded = False
+    for category, command in BENCHMARK_COMMANDS:
+        if nvmesh.get_startup_category(command) != category:
+            raise Exception("'%s' is not a %s command." % (command, category))
+        budget = nvmesh.STARTUP_BUDGETS[category][0]
+        elapsed, details = time_command(here, command, runs)
+        exceeded = exceeded or elapsed > budget
+        print("%-14s %-6s cold start %.3fs, budget %.3fs %s" % (
+            command, category, elapsed, budget, "OK" if elapsed <= budget else "Exceeded"))
+        print("    %s" % details)
+    return 1 if exceeded else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())